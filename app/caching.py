@@ -1,21 +1,174 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from functools import wraps
 from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db.models import Model, QuerySet
 
 
-def cached(seconds=60, key=None, version=None):
+# how long a recomputation may hold the lock, and how long other callers wait on it when there is nothing to serve
+LOCK_TIMEOUT = 30
+LOCK_WAIT = 5
+LOCK_POLL = 0.05
+LOCAL_SIZE = 512
+TAG_LOCAL_SECONDS = 5
+
+# cache tags, bumped by whatever writes the data they cover
+STATIONS = 'stations'
+AREAS = 'areas'
+
+
+class LocalCache:
+    """
+    A small thread-safe LRU kept by each process in front of the shared cache, whose entries expire quickly so
+    processes never disagree for long.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, seconds):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + seconds, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local_cache = LocalCache(LOCAL_SIZE)
+
+
+def cached(seconds=60, key=None, version=None, stale=60, local_seconds=5, tags=()):
+    """
+    Memoizes a function in the shared cache, keyed on its arguments (querysets by their SQL, model instances by
+    their primary key) and on the current versions of `tags`, so `bump_tags` retires every entry depending on
+    them. Any result is cached, including None and empty ones.
+
+    Only one process recomputes an entry at a time: for `stale` seconds after an entry expires the others keep
+    serving the old value while it is refreshed, and when there is no value at all they wait for it.
+    Entries are also kept in a per-process LRU for `local_seconds`.
+    """
     def decorator(func):
+        prefix = key or f'func:{func.__module__}.{func.__qualname__}'
+
+        def make_key(*args, **kwargs):
+            parts = [key_part(arg) for arg in args] + [f'{k}={key_part(v)}' for k, v in sorted(kwargs.items())]
+            if tags:
+                parts.append(tag_versions(tags))
+            return f'{prefix}:{hashlib.md5("|".join(parts).encode()).hexdigest()}'
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if key:
-                cache_key = key
-            else:
-                cache_key = f'func:{func.__name__}'
-            result = cache.get(cache_key)
-            if not result:
+            cache_key = make_key(*args, **kwargs)
+            local_key = (cache_key, version)
+            now = time.time()
+
+            entry = local_cache.get(local_key)
+            if entry is None or entry[0] < now:
+                entry = cache.get(cache_key, version=version)
+                if entry is not None:
+                    local_cache.set(local_key, entry, local_seconds)
+            if entry is not None and entry[0] >= now:
+                return entry[1]
+
+            lock_key = f'{cache_key}:lock'
+            locked = cache.add(lock_key, True, LOCK_TIMEOUT, version=version)
+            if not locked:
+                if entry is None:
+                    entry = wait_for(cache_key, version)
+                if entry is not None:
+                    return entry[1]
+
+            try:
                 result = func(*args, **kwargs)
-                cache.set(cache_key, result, seconds, version)
+                entry = (time.time() + seconds, result)
+                cache.set(cache_key, entry, seconds + stale, version=version)
+                local_cache.set(local_key, entry, local_seconds)
+            finally:
+                # a caller that gave up waiting computes without the lock, which stays with its holder
+                if locked:
+                    cache.delete(lock_key, version=version)
             return result
 
+        def invalidate(*args, **kwargs):
+            cache_key = make_key(*args, **kwargs)
+            cache.delete(cache_key, version=version)
+            local_cache.delete((cache_key, version))
+
+        wrapper.invalidate = invalidate
         return wrapper
 
     return decorator
+
+
+def tag_versions(tags) -> str:
+    """
+    Returns a string identifying the current versions of `tags`, to be made part of a cache key.
+    """
+    versions = {}
+    for tag in tags:
+        if (tag_version := local_cache.get(('tag', tag))) is not None:
+            versions[tag] = tag_version
+    if missing := [tag for tag in tags if tag not in versions]:
+        for tag in missing:
+            cache.add(f'tag:{tag}', uuid.uuid4().hex, None)
+        stored = cache.get_many([f'tag:{tag}' for tag in missing])
+        for tag in missing:
+            versions[tag] = stored.get(f'tag:{tag}', '')
+            local_cache.set(('tag', tag), versions[tag], TAG_LOCAL_SECONDS)
+    return '.'.join(versions[tag] for tag in tags)
+
+
+def bump_tags(*tags):
+    """
+    Gives each of `tags` a new version, retiring every cache entry keyed on the old one.
+    """
+    cache.set_many({f'tag:{tag}': uuid.uuid4().hex for tag in tags}, None)
+    for tag in tags:
+        local_cache.delete(('tag', tag))
+
+
+def key_part(value) -> str:
+    if isinstance(value, QuerySet):
+        try:
+            sql = str(value.query)
+        except EmptyResultSet:
+            sql = 'empty'
+        return f'{value.model._meta.label}:{sql}'
+    if isinstance(value, Model):
+        return f'{value._meta.label}:{value.pk}'
+    return repr(value)
+
+
+def wait_for(cache_key, version):
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL)
+        if (entry := cache.get(cache_key, version=version)) is not None:
+            return entry
+    return None
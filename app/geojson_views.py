@@ -1,7 +1,19 @@
-from django.http import JsonResponse, HttpResponse
+import json
+from django.http import JsonResponse, StreamingHttpResponse
+from django.contrib.gis.db.models import Collect
+from django.contrib.gis.db.models.functions import AsGeoJSON, Centroid, SnapToGrid
 from django.contrib.gis.geos import Polygon
-from django.core.serializers import serialize
+from django.db.models import Count, F, Q, Sum
 from app.models import Station
+from app.tile_views import MAX_ZOOM
+
+
+# below this zoom level stations are returned as grid clusters rather than individual points
+CLUSTER_MAX_ZOOM = 10
+# cluster cells per 256px tile width
+CLUSTER_CELLS_PER_TILE = 8
+# the most stations returned as points in one response
+MAX_STATIONS = 5000
 
 
 def stations_in_bounds(request):
@@ -15,13 +27,85 @@ def stations_in_bounds(request):
     except ValueError:
         return JsonResponse({'error': 'Invalid bounds format'}, status=400)
 
+    try:
+        zoom = float(request.GET['zoom']) if request.GET.get('zoom') else None
+        limit = min(int(request.GET.get('limit') or MAX_STATIONS), MAX_STATIONS)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid zoom or limit'}, status=400)
+    if limit < 0 or (zoom is not None and not 0 <= zoom <= MAX_ZOOM):
+        return JsonResponse({'error': 'Invalid zoom or limit'}, status=400)
+
     # Create a polygon from the bounding box
     bbox_polygon = Polygon.from_bbox((sw_lng, sw_lat, ne_lng, ne_lat))
 
-    # Filter stations within the bounding box
-    stations = Station.objects.filter(point__within=bbox_polygon)
+    # Filter stations by bounding box overlap (&&), which is answered from the spatial index alone for points
+    stations = filter_stations(Station.objects.filter(point__bboverlaps=bbox_polygon), request.GET)
+
+    if zoom is not None and zoom < CLUSTER_MAX_ZOOM:
+        return JsonResponse(clusters_geojson(stations, zoom))
+
+    stations = stations.order_by(F('ev_dc_fast_num').desc(nulls_last=True), 'id')
+    return StreamingHttpResponse(stream_geojson(stations, limit), content_type='application/json')
+
+
+def filter_stations(stations, params):
+    """
+    Applies the same network, plug type, DC fast and primaries-only filters as the updates feed.
+    """
+    if ev_networks := list(filter(bool, params.getlist('ev_network'))):
+        stations = stations.filter(ev_network__in=ev_networks)
+    if plug_types := list(filter(bool, params.getlist('plug_types'))):
+        q = Q()
+        for t in plug_types:
+            q |= Q(ev_connector_types__contains=t)
+        stations = stations.filter(q)
+    if params.get('dc_fast') == 'true':
+        stations = stations.filter(ev_dc_fast_num__gt=0)
+    if params.get('primaries') == 'true':
+        stations = stations.primaries()
+    return stations
+
+
+def stream_geojson(stations, limit=MAX_STATIONS):
+    """
+    Writes the stations out as a GeoJSON FeatureCollection shaped like Django's geojson serializer output, selecting
+    only the columns needed and having PostGIS encode the geometry, so no model instances are built.
+    A `truncated` member after the features says whether more than `limit` stations matched.
+    """
+    rows = stations.values_list('id', 'beacon_name', 'ev_dc_fast_num', AsGeoJSON('point', precision=6))
+    yield '{"type": "FeatureCollection", "crs": {"type": "name", "properties": {"name": "EPSG:4326"}}, "features": ['
+    truncated = False
+    for i, (pk, beacon_name, ev_dc_fast_num, geometry) in enumerate(rows[:limit + 1].iterator(chunk_size=2000)):
+        if i == limit:
+            truncated = True
+            break
+        properties = json.dumps({'beacon_name': beacon_name, 'ev_dc_fast_num': ev_dc_fast_num})
+        separator = ', ' if i else ''
+        yield f'{separator}{{"type": "Feature", "id": {pk}, "properties": {properties}, "geometry": {geometry}}}'
+    yield f'], "truncated": {json.dumps(truncated)}}}'
 
-    # Serialize queryset to GeoJSON
-    geojson = serialize('geojson', stations, geometry_field='point', fields=('beacon_name', 'ev_dc_fast_num'))
 
-    return HttpResponse(geojson, content_type='application/json')
+def clusters_geojson(stations, zoom) -> dict:
+    """
+    Aggregates stations into grid cells sized to the zoom level, returning one feature per non-empty cell
+    placed at the centroid of its stations.
+    """
+    cell_size = 360 / (2 ** int(zoom)) / CLUSTER_CELLS_PER_TILE
+    clusters = (
+        stations
+        .annotate(cell=SnapToGrid('point', cell_size))
+        .values('cell')
+        .annotate(count=Count('id'), dc_fast=Sum('ev_dc_fast_num'), center=Centroid(Collect('point')))
+        .values_list('count', 'dc_fast', 'center')
+    )
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'properties': {'cluster': True, 'count': count, 'ev_dc_fast_num': dc_fast or 0},
+                'geometry': {'type': 'Point', 'coordinates': [center.x, center.y]},
+            }
+            for count, dc_fast, center in clusters
+        ],
+    }
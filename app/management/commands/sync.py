@@ -5,5 +5,21 @@ from app.syncer import sync
 class Command(BaseCommand):
     help = "Syncs the database with the NREL server"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source', type=str, default=None,
+            help='Path to a local NREL response document to import instead of querying the API'
+        )
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='Skip removing stations missing from the feed and only relink the stations that changed. '
+                 'The whole feed is still downloaded'
+        )
+
     def handle(self, *args, **options):
-        sync()
+        stats = sync(options['source'], incremental=options['incremental'])
+        self.stdout.write(
+            f'{stats.created} created {stats.updated} updated {stats.skipped} skipped {stats.deleted} deleted'
+        )
+        if stats.withheld:
+            self.stderr.write(f'{stats.withheld} stations missing from the feed were not deleted')
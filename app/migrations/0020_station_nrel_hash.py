@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2024-02-03 18:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_alter_update_created_at_alter_update_station'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='station',
+            name='nrel_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True),
+        ),
+    ]
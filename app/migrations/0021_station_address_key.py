@@ -0,0 +1,34 @@
+# Generated by Django 5.0.1 on 2024-02-04 21:40
+
+from django.db import migrations, models
+
+
+def populate_address_key(apps, schema_editor):
+    Station = apps.get_model('app', 'Station')
+    stations = Station.objects.only('id', 'ev_network', 'street_address', 'city', 'state')
+    batch = []
+    for station in stations.iterator(chunk_size=1000):
+        station.address_key = (
+            f'{station.ev_network}: {station.street_address}, {station.city}, {station.state}'.lower()
+        )
+        batch.append(station)
+        if len(batch) >= 1000:
+            Station.objects.bulk_update(batch, ['address_key'])
+            batch = []
+    Station.objects.bulk_update(batch, ['address_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_station_nrel_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='station',
+            name='address_key',
+            field=models.TextField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunPython(populate_address_key, migrations.RunPython.noop),
+    ]
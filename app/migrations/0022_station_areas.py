@@ -0,0 +1,26 @@
+# Generated by Django 5.0.1 on 2024-02-06 05:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_station_address_key'),
+        ('beacon', '0015_alter_searchresult_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='station',
+            name='areas',
+            field=models.ManyToManyField(blank=True, editable=False, related_name='stations', to='beacon.area'),
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO app_station_areas (station_id, area_id)
+            SELECT s.id, a.id FROM app_station s INNER JOIN beacon_area a ON ST_Intersects(a.geom, s.point)
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2024-02-09 17:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0022_station_areas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='update',
+            name='changes',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
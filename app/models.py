@@ -1,102 +1,258 @@
+import hashlib
+import uuid
+from itertools import islice
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import Point
-from django.contrib.gis.db.models.aggregates import Union
+from django.contrib.postgres.expressions import ArraySubquery
 from django.contrib.postgres.indexes import GinIndex
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, OuterRef
 from django.urls import reverse
 from django.utils import dateparse, timezone
 from django.core.serializers.json import json, DjangoJSONEncoder
 from simple_history.models import HistoricalRecords
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
 import randomname
 from django.forms import model_to_dict
-from beacon.models import Area
-from app.caching import cached
+from beacon.models import Area, AreaPiece
+from app.caching import STATIONS, bump_tags, cached
 from app.constants import LOOKUPS
-from app.tasks import publish_update
+from app.tasks import publish_updates
 
 
 class ImportStats:
     created: int
     updated: int
     skipped: int
+    deleted: int
+    withheld: int
+    address_keys: set[str]
 
     def __init__(self):
         self.created = 0
         self.updated = 0
         self.skipped = 0
+        self.deleted = 0
+        self.withheld = 0
+        self.address_keys = set()
+
+
+IMPORT_FIELDS = [
+    'id', 'access_code', 'access_days_time', 'access_detail_code', 'cards_accepted', 'date_last_confirmed',
+    'expected_date', 'fuel_type_code', 'groups_with_access_code', 'maximum_vehicle_class', 'open_date',
+    'owner_type_code', 'restricted_access', 'status_code', 'facility_type', 'station_name', 'station_phone',
+    'updated_at', 'geocode_status', 'latitude', 'longitude', 'city', 'country', 'intersection_directions',
+    'plus4', 'state', 'street_address', 'zip', 'ev_connector_types', 'ev_dc_fast_num', 'ev_level1_evse_num',
+    'ev_level2_evse_num', 'ev_network', 'ev_network_web', 'ev_other_evse', 'ev_pricing', 'ev_renewable_source',
+    'ev_workplace_charging', 'nps_unit_name', 'ev_network_ids'
+]
+NO_HISTORY_FIELDS = {'updated_at', 'date_last_confirmed'}
+# a full sync refuses to delete more than this share of the stations, which points at a truncated feed
+MAX_DELETED_RATIO = 0.05
 
 
 class StationQuerySet(models.QuerySet):
-    def import_from_nrel(self, data) -> ImportStats:
+    def import_from_nrel(self, data, batch_size=1000, reconcile=False,
+                         max_deleted_ratio=MAX_DELETED_RATIO) -> ImportStats:
+        """
+        Imports NREL stations. With `reconcile`, `data` is treated as the complete feed and stations missing from
+        it are deleted, unless they are more than `max_deleted_ratio` of all stations.
+        """
+        stations = data['fuel_stations'] if isinstance(data, dict) else data
         stats = ImportStats()
-        interesting_fields = [
-            'id', 'access_code', 'access_days_time', 'access_detail_code', 'cards_accepted', 'date_last_confirmed',
-            'expected_date', 'fuel_type_code', 'groups_with_access_code', 'maximum_vehicle_class', 'open_date',
-            'owner_type_code', 'restricted_access', 'status_code', 'facility_type', 'station_name', 'station_phone',
-            'updated_at', 'geocode_status', 'latitude', 'longitude', 'city', 'country', 'intersection_directions',
-            'plus4', 'state', 'street_address', 'zip', 'ev_connector_types', 'ev_dc_fast_num', 'ev_level1_evse_num',
-            'ev_level2_evse_num', 'ev_network', 'ev_network_web', 'ev_other_evse', 'ev_pricing', 'ev_renewable_source',
-            'ev_workplace_charging', 'nps_unit_name', 'ev_network_ids'
-        ]
-        no_history_fields = {'updated_at', 'date_last_confirmed'}
-        for station in data['fuel_stations']:
-            clean_station_json(station)
+        seen = set()
+        for batch in chunked(stations, batch_size):
+            seen.update(station['id'] for station in batch)
+            self._import_batch(batch, stats, batch_size)
 
-            qs = self.filter(id=station['id'])
-            create = Station(**{k: v for k, v in station.items() if k in interesting_fields})
-            updated_fields = []
-            update = None
-
-            if qs.exists():
-                existing = qs.first()
-                for field in interesting_fields:
-                    f1 = getattr(existing, field)
-                    f2 = getattr(create, field)
-                    if f1 != f2:
-                        updated_fields.append(field)
-                        setattr(existing, field, f2)
-                point_updated = update_point(station, existing)
-                if updated_fields or point_updated:
-                    if not updated_fields:
-                        existing.skip_history_when_saving = True
-                    existing.save()
-                if not all(f in no_history_fields for f in updated_fields):
-                    stats.updated += 1
-                    update = Update.objects.station_updated(existing)
-                else:
-                    stats.skipped += 1
-            else:
-                update_point(station, create)
-                create.save()
-                stats.created += 1
-                update = Update.objects.station_updated(create, is_creation=True)
-
-            if update:
-                publish_update.delay(update.id)
+        if reconcile and seen:
+            self.delete_missing(seen, stats, batch_size, max_deleted_ratio)
 
         return stats
 
-    def link_stations(self):
-        all_stations = self.all()
-        matches = {}
-        for station in all_stations:
-            key = station.key()
-            if key not in matches:
-                matches[key] = []
-            matches[key].append(station)
-        for key, stations in matches.items():
-            if len(stations) > 1:
-                stations = sorted(stations, key=lambda x: x.id)
-                for station in stations[1:]:
-                    if station.linked_to != stations[0]:
-                        station.skip_history_when_saving = True
-                        station.linked_to = stations[0]
-                        station.save()
+    def _import_batch(self, batch, stats, batch_size) -> list['Update']:
+        if not batch:
+            return []
+        hashes = {station['id']: nrel_hash(station) for station in batch}
+        stored_hashes = self.filter(id__in=hashes).values_list('id', 'nrel_hash')
+        unchanged = {pk for pk, stored in stored_hashes if stored == hashes[pk]}
+        stats.skipped += len(unchanged)
+        batch = [station for station in batch if station['id'] not in unchanged]
+        if not batch:
+            return []
+
+        for station in batch:
+            clean_station_json(station)
+
+        existing_stations = self.in_bulk([station['id'] for station in batch])
+        defaults = {f: Station._meta.get_field(f).get_default() for f in IMPORT_FIELDS}
+        created = []
+        updated = []
+        touched = []
+        moved_ids = []
+        updated_fields = {'nrel_hash', 'address_key'}
+        previous = {}
+        updates = []
+
+        new_stations = [station for station in batch if station['id'] not in existing_stations]
+        beacon_names = get_beacon_names(len(new_stations))
+        for station, beacon_name in zip(new_stations, beacon_names):
+            create = Station(
+                beacon_name=beacon_name,
+                nrel_hash=hashes[station['id']],
+                **{f: station.get(f, defaults[f]) for f in IMPORT_FIELDS}
+            )
+            create.address_key = create.key()
+            update_point(station, create)
+            created.append(create)
+            stats.address_keys.add(create.address_key)
+
+        for station in batch:
+            existing = existing_stations.get(station['id'])
+            if existing is None:
+                continue
+            before = dict_from_model(existing)
+            changed_fields = []
+            for field in IMPORT_FIELDS:
+                value = station.get(field, defaults[field])
+                if getattr(existing, field) != value:
+                    changed_fields.append(field)
+                    setattr(existing, field, value)
+            point_updated = update_point(station, existing)
+            if point_updated:
+                moved_ids.append(existing.id)
+            existing.nrel_hash = hashes[existing.id]
+            if existing.address_key != existing.key():
+                if existing.address_key is not None:
+                    stats.address_keys.add(existing.address_key)
+                existing.address_key = existing.key()
+                stats.address_keys.add(existing.address_key)
+            if changed_fields:
+                updated.append(existing)
+                updated_fields.update(changed_fields)
+                if point_updated:
+                    updated_fields.add('point')
+            else:
+                # only the point or the derived columns moved, none of which are tracked in history
+                touched.append(existing)
+            if not all(f in NO_HISTORY_FIELDS for f in changed_fields):
+                stats.updated += 1
+                previous[existing.id] = before
+            else:
+                stats.skipped += 1
+
+        with transaction.atomic():
+            if created:
+                bulk_create_with_history(created, Station, batch_size=batch_size)
+                stats.created += len(created)
+            if updated:
+                bulk_update_with_history(updated, Station, sorted(updated_fields), batch_size=batch_size)
+            if touched:
+                self.bulk_update(touched, ['point', 'nrel_hash', 'address_key'], batch_size=batch_size)
+            if created or moved_ids:
+                Station.objects.filter(id__in=[station.id for station in created] + moved_ids).refresh_areas()
+
+            from app.renderer import summarize_changes
+            now = timezone.now()
+            for station in created:
+                updates.append(Update(
+                    station=station, created_at=now, is_creation=True, current=dict_from_model(station), changes=[]
+                ))
+            for station in updated:
+                if station.id in previous:
+                    current = dict_from_model(station)
+                    updates.append(Update(
+                        station=station, created_at=now, current=current, previous=previous[station.id],
+                        changes=summarize_changes(previous[station.id], current)
+                    ))
+            updates = Update.objects.bulk_create(updates, batch_size=batch_size)
+            # each batch commits on its own, so it is published on its own and survives a later batch failing
+            if update_ids := [update.id for update in updates]:
+                transaction.on_commit(lambda: publish_updates.delay(update_ids))
+
+        return updates
+
+    def delete_missing(self, seen_ids, stats, batch_size=1000, max_deleted_ratio=MAX_DELETED_RATIO):
+        """
+        Deletes the stations not in `seen_ids`, along with their updates and search results. When too many are
+        missing nothing is deleted and they are counted as withheld instead.
+        """
+        all_ids = set(self.values_list('id', flat=True))
+        missing = all_ids - seen_ids
+        if len(missing) > len(all_ids) * max_deleted_ratio:
+            stats.withheld += len(missing)
+            return
+        for ids in chunked(missing, batch_size):
+            qs = self.filter(id__in=ids)
+            stats.address_keys.update(qs.exclude(address_key=None).values_list('address_key', flat=True))
+            qs.delete()
+        stats.deleted += len(missing)
+
+    def link_stations(self, address_keys=None):
+        """
+        Links stations sharing an address key to the one with the lowest id. Given `address_keys`, only those
+        groups are relinked, otherwise every station is considered.
+        """
+        if address_keys is None:
+            relinked = self._link_address_keys(self.all())
+        else:
+            relinked = sum(self._link_address_keys(self.filter(address_key__in=keys))
+                           for keys in chunked(address_keys, 1000))
+        if relinked:
+            bump_tags(STATIONS)
+
+    def _link_address_keys(self, qs):
+        qs = qs.exclude(address_key=None)
+        primaries = dict(
+            qs.order_by().values('address_key').annotate(primary_id=models.Min('id'))
+            .values_list('address_key', 'primary_id')
+        )
+        relinked = []
+        for station in qs.only('id', 'address_key', 'linked_to'):
+            primary_id = primaries[station.address_key]
+            linked_to_id = primary_id if station.id != primary_id else None
+            if station.linked_to_id != linked_to_id:
+                station.linked_to_id = linked_to_id
+                relinked.append(station)
+        Station.objects.bulk_update(relinked, ['linked_to'], batch_size=1000)
+        return len(relinked)
+
+    def refresh_areas(self):
+        """
+        Recomputes which areas contain each station in this queryset. Like `refresh_area_members`, a station on an
+        area's boundary counts as within it.
+        """
+        containing = AreaPiece.objects.filter(geom__intersects=OuterRef('point')).values('area_id')
+        rows = list(self.annotate(area_ids=ArraySubquery(containing)).values_list('id', 'area_ids'))
+        StationArea = Station.areas.through
+        StationArea.objects.filter(station_id__in=[station_id for station_id, _ in rows]).delete()
+        StationArea.objects.bulk_create([
+            StationArea(station_id=station_id, area_id=area_id)
+            for station_id, area_ids in rows
+            for area_id in set(area_ids)
+        ], batch_size=1000)
+
+    def refresh_area_members(self, area_ids, batch_size=100):
+        """
+        Recomputes which stations in this queryset fall within each of the given areas.
+        """
+        StationArea = Station.areas.through
+        for ids in chunked(area_ids, batch_size):
+            within = self.filter(point__intersects=OuterRef('geom')).values('id')
+            rows = (
+                AreaPiece.objects.filter(area_id__in=ids).annotate(station_ids=ArraySubquery(within))
+                .values_list('area_id', 'station_ids')
+            )
+            members = {(station_id, area_id) for area_id, station_ids in rows for station_id in station_ids}
+            StationArea.objects.filter(area_id__in=ids, station_id__in=self.values('id')).delete()
+            StationArea.objects.bulk_create([
+                StationArea(station_id=station_id, area_id=area_id) for station_id, area_id in members
+            ], batch_size=1000)
 
     def primaries(self):
         return self.filter(linked_to__isnull=True)
 
-    @cached(60 * 60 * 24, key='all_station_networks', version=1)
+    @cached(60 * 60 * 24 * 30, key='all_station_networks', version=1, tags=[STATIONS])
     def all_networks(self):
         count = models.Count('ev_network', filter=models.Q(linked_to__isnull=True))
         result = self.values('ev_network').annotate(count=count).order_by('ev_network')
@@ -135,6 +291,15 @@ def get_beacon_name():
     return name
 
 
+def get_beacon_names(count) -> list[str]:
+    names = set()
+    while len(names) < count:
+        candidates = {randomname.generate(*NAME_ARGS) for _ in range(count - len(names))} - names
+        taken = Station.objects.filter(beacon_name__in=candidates).values_list('beacon_name', flat=True)
+        names |= candidates - set(taken)
+    return list(names)
+
+
 class Station(models.Model):
     id = models.IntegerField(primary_key=True)
     beacon_name = models.SlugField(max_length=255, default=get_beacon_name, unique=True)
@@ -180,7 +345,10 @@ class Station(models.Model):
     linked_to = models.ForeignKey(
         'self', on_delete=models.SET_NULL, blank=True, null=True, related_name='linked', editable=False
     )
-    history = HistoricalRecords()
+    nrel_hash = models.CharField(max_length=32, blank=True, null=True, editable=False)
+    address_key = models.TextField(blank=True, null=True, editable=False, db_index=True)
+    areas = models.ManyToManyField(Area, related_name='stations', blank=True, editable=False)
+    history = HistoricalRecords(excluded_fields=['nrel_hash', 'address_key'])
     point = models.PointField(blank=True, null=True)
 
     objects = StationQuerySet.as_manager()
@@ -198,6 +366,19 @@ class Station(models.Model):
     def state_as_handle(self):
         return state_as_handle(self.state)
 
+    def save(self, *args, **kwargs):
+        self.address_key = self.key()
+        # an edit made outside the importer no longer matches the feed, so the next sync compares every field again.
+        # A fresh marker rather than None also moves the cached card fragments' key on every edit.
+        self.nrel_hash = f'edited:{uuid.uuid4().hex[:25]}'
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'address_key', 'nrel_hash'}
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'point' in update_fields:
+            Station.objects.filter(id=self.id).refresh_areas()
+        bump_tags(STATIONS)
+
     def get_absolute_url(self):
         return reverse('station', kwargs={'beacon_name': self.beacon_name})
 
@@ -245,6 +426,7 @@ class Persona(models.Model):
 
 class UpdateQuerySet(models.QuerySet):
     def station_updated(self, station, is_creation=False):
+        from app.renderer import summarize_changes
         history = station.history.filter()[:2]
         args = {
             'station': station,
@@ -253,6 +435,7 @@ class UpdateQuerySet(models.QuerySet):
             'current': dict_from_model(history[0]),
             'previous': dict_from_model(history[1]) if len(history) > 1 else None,
         }
+        args['changes'] = summarize_changes(args['previous'], args['current'])
         return self.create(**args)
 
     def feed(self, ev_networks: list[str] = None, areas: list[str] = None, ev_connector_types: list[str] = None,
@@ -265,9 +448,8 @@ class UpdateQuerySet(models.QuerySet):
         if ev_networks:
             qs = qs.filter(station__ev_network__in=ev_networks)
         if areas:
-            areas = Area.objects.filter(id__in=areas)
-            combined_geom = areas.aggregate(area=Union('geom'))['area']
-            qs = qs.filter(station__point__within=combined_geom)
+            members = Station.areas.through.objects.filter(area_id__in=areas).values('station_id')
+            qs = qs.filter(station__in=members)
         if ev_connector_types:
             q = Q()
             for t in ev_connector_types:
@@ -282,6 +464,7 @@ class Update(models.Model):
     is_creation = models.BooleanField(default=False, db_index=True)
     current = models.JSONField(blank=True, null=True)
     previous = models.JSONField(blank=True, null=True)
+    changes = models.JSONField(blank=True, null=True, editable=False)
 
     objects = UpdateQuerySet.as_manager()
 
@@ -326,6 +509,17 @@ def clean_station_json(station_json):
         station_json['longitude'] = float(station_json['longitude'])
 
 
+def nrel_hash(station_json) -> str:
+    payload = json.dumps({f: station_json.get(f) for f in IMPORT_FIELDS}, sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
 def update_point(cleaned_station_json, station) -> bool:
     latitude = cleaned_station_json.get('latitude', None)
     longitude = cleaned_station_json.get('longitude', None)
@@ -0,0 +1,114 @@
+import codecs
+from contextlib import contextmanager
+from json import JSONDecoder, JSONDecodeError
+import requests
+from django.conf import settings
+
+
+URL = 'https://developer.nrel.gov/api/alt-fuel-stations/v1.json'
+params = {
+    'fuel_type': 'ELEC',
+    'api_key': settings.NREL_API_KEY,
+    'country': 'all',
+}
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+
+
+@contextmanager
+def open_fuel_stations(source=None, **extra_params):
+    """
+    Opens the NREL alt-fuel-stations feed and yields an iterator of station dicts.
+    `source` may be a local fixture file standing in for the API; by default the API is queried.
+    """
+    if source and not source.startswith('https://'):
+        with open(source, 'rb') as f:
+            yield iter_fuel_stations(f)
+        return
+
+    with requests.get(source or URL, params={**params, **extra_params}, stream=True) as res:
+        res.raise_for_status()
+        res.raw.decode_content = True
+        yield iter_fuel_stations(res.raw)
+
+
+def iter_fuel_stations(fp, chunk_size=CHUNK_SIZE):
+    """
+    Incrementally parses an NREL response document from a file-like object, yielding each entry of
+    its `fuel_stations` array as soon as it has been read. Other top-level values are skipped.
+    """
+    reader = JSONStreamReader(fp, chunk_size)
+    reader.expect('{')
+    while reader.peek() != '}':
+        key = reader.value()
+        reader.expect(':')
+        if key == 'fuel_stations':
+            reader.expect('[')
+            while reader.peek() != ']':
+                yield reader.value()
+                reader.skip(',')
+            reader.expect(']')
+        else:
+            reader.value()
+        reader.skip(',')
+    reader.expect('}')
+
+
+class JSONStreamReader:
+    def __init__(self, fp, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = ''
+        while not chunk:
+            raw = self.fp.read(self.chunk_size)
+            chunk = self.text_decoder.decode(raw, final=not raw) if isinstance(raw, bytes) else raw
+            if not raw:
+                self.eof = True
+                if not chunk:
+                    return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def skip(self, char):
+        if self.peek() == char:
+            self.pos += 1
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise JSONDecodeError(f'Expecting {char!r}, found {found!r}', self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # a number running into the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return obj
@@ -0,0 +1,97 @@
+import json
+from datetime import datetime, timedelta, timezone
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class KeysetPaginator:
+    """
+    Paginates a queryset newest first on `(created_at, id)` using cursors rather than offsets, so every page
+    costs the same to fetch no matter how deep it is.
+    """
+
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+
+    def get_page(self, before=None, after=None, last=False) -> 'KeysetPage':
+        return KeysetPage(self, decode_cursor(before), decode_cursor(after), last)
+
+    @cached_property
+    def approximate_total(self):
+        """
+        The planner's row estimate for the queryset, which avoids running a COUNT(*) over it.
+        """
+        if connections[self.queryset.db].vendor != 'postgresql':
+            return None
+        plan = json.loads(self.queryset.order_by().explain(format='json'))
+        return plan[0]['Plan']['Plan Rows']
+
+
+class KeysetPage:
+    def __init__(self, paginator, before, after, last):
+        self.paginator = paginator
+        self.before = before
+        self.after = after
+        self.last = last
+
+    @cached_property
+    def _window(self):
+        qs = self.paginator.queryset
+        per_page = self.paginator.per_page
+        if self.after or self.last:
+            qs = qs.order_by('created_at', 'id')
+            if self.after:
+                created_at, pk = self.after
+                qs = qs.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+            items = list(qs[:per_page + 1])
+            has_previous = len(items) > per_page
+            return list(reversed(items[:per_page])), has_previous, bool(self.after)
+
+        qs = qs.order_by('-created_at', '-id')
+        if self.before:
+            created_at, pk = self.before
+            qs = qs.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+        items = list(qs[:per_page + 1])
+        return items[:per_page], bool(self.before), len(items) > per_page
+
+    @property
+    def object_list(self):
+        return self._window[0]
+
+    def has_previous(self):
+        return self._window[1]
+
+    def has_next(self):
+        return self._window[2]
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def previous_cursor(self):
+        return encode_cursor(self.object_list[0]) if self.object_list else None
+
+    def next_cursor(self):
+        return encode_cursor(self.object_list[-1]) if self.object_list else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(obj) -> str:
+    delta = obj.created_at - EPOCH
+    return f'{(delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds}.{obj.id}'
+
+
+def decode_cursor(cursor):
+    try:
+        micros, pk = cursor.split('.')
+        return EPOCH + timedelta(microseconds=int(micros)), int(pk)
+    except (AttributeError, ValueError):
+        return None
@@ -1,6 +1,10 @@
 from dataclasses import dataclass
 
 from dictdiffer import diff
+from django.core.cache import cache
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
 
 from app.constants import LOOKUPS
 from app.models import Update, clean_station_json
@@ -15,20 +19,56 @@ class Change:
     current: str
 
 
+# bump when the card body templates change so stale fragments stop being served
+FRAGMENT_VERSION = 1
+FRAGMENT_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def render_update_fragment(template_name: str, upd: Update) -> str:
+    """
+    Renders the body of an update's station card, caching the HTML. An update never changes once written, so the
+    fragment only goes stale when the station does, which changes its `nrel_hash` (on a sync or a `Station.save`)
+    and with it the cache key.
+    """
+    key = fragment_key(template_name, upd)
+    html = cache.get(key)
+    if html is None:
+        html = get_template(template_name).render({
+            'update': upd,
+            'station': upd.station,
+            'new': upd.is_creation,
+            'changes': get_changes(upd),
+        })
+        cache.set(key, html, FRAGMENT_TIMEOUT)
+    return mark_safe(html)
+
+
+def fragment_key(template_name: str, upd: Update) -> str:
+    return f'fragment:{template_name}:{FRAGMENT_VERSION}:{get_language()}:{upd.id}:{upd.station.nrel_hash}'
+
+
 def get_changes(upd: Update) -> [Change]:
+    if upd.changes is not None:
+        return [Change('change', f, field_display_name(f), fva, fvb) for f, fva, fvb in upd.changes]
+    return diff_changes(upd.previous, upd.current)
+
+
+def diff_changes(previous: dict, current: dict) -> [Change]:
     result = []
-    if not upd.previous:
+    if not previous:
         return result
-    clean_station_json(upd.previous)
-    clean_station_json(upd.current)
-    changes = diff(upd.previous, upd.current)
+    previous = dict(previous)
+    current = dict(current)
+    clean_station_json(previous)
+    clean_station_json(current)
+    changes = diff(previous, current)
     for desc, field, change in changes:
         if desc == 'change':
             if isinstance(field, list):
                 field = field[0]
             if field in ignore_fields:
                 continue
-            fn = field.replace('_', ' ').title()
+            fn = field_display_name(field)
             fva = render_field(field, change[0])
             fvb = render_field(field, change[1])
             result.append(Change('change', field, fn, fva, fvb))
@@ -36,6 +76,17 @@ def get_changes(upd: Update) -> [Change]:
     return result
 
 
+def summarize_changes(previous: dict, current: dict) -> list[list]:
+    """
+    The compact form of `diff_changes` stored on `Update.changes`.
+    """
+    return [[c.field, c.previous, c.current] for c in diff_changes(previous, current)]
+
+
+def field_display_name(field: str) -> str:
+    return field.replace('_', ' ').title()
+
+
 def render_field(field: str, value: str) -> str:
     if value is None:
         return ''
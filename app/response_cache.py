@@ -0,0 +1,79 @@
+import hashlib
+from functools import wraps
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db.models import Max
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date, urlencode
+from django.utils.translation import get_language
+from app.caching import AREAS, STATIONS, tag_versions
+from app.models import Update
+
+
+LAST_MODIFIED_KEY = 'feed_last_modified'
+RESPONSE_TIMEOUT = 60 * 60 * 6
+
+
+def cache_anonymous_response(view):
+    """
+    Serves anonymous GETs of an updates view from a cache keyed on its normalized query parameters, and answers
+    conditional requests with 304 Not Modified until new updates are published.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'GET' or request.user.is_authenticated or len(get_messages(request)):
+            return view(request, *args, **kwargs)
+
+        version = feed_last_modified()
+        key = response_key(request, version)
+
+        cached = cache.get(key)
+        if cached is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200 or response.streaming:
+                return response
+            # views that compute their own, finer grained validators keep them
+            response.setdefault('ETag', f'"{key.split(":")[-1]}"')
+            response.setdefault('Last-Modified', http_date(int(version)))
+            cached = (response.content, response['Content-Type'], response['ETag'], response['Last-Modified'])
+            cache.set(key, cached, RESPONSE_TIMEOUT)
+
+        content, content_type, etag, last_modified = cached
+        response = get_conditional_response(request, etag=etag, last_modified=parse_http_date(last_modified))
+        if response is None:
+            response = HttpResponse(content, content_type=content_type)
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        return response
+
+    return wrapper
+
+
+def response_key(request, version) -> str:
+    params = sorted(
+        (name, value)
+        for name, values in request.GET.lists()
+        for value in values
+        if value
+    )
+    raw = (f'{request.scheme}://{request.get_host()}{request.path}?{urlencode(params)}:{get_language()}:{version}:'
+           f'{tag_versions([STATIONS, AREAS])}')
+    return f'response:{hashlib.md5(raw.encode()).hexdigest()}'
+
+
+def feed_last_modified() -> float:
+    """
+    The timestamp of the newest update, which versions every cached response.
+    """
+    version = cache.get(LAST_MODIFIED_KEY)
+    if version is None:
+        version = invalidate_response_cache()
+    return version
+
+
+def invalidate_response_cache() -> float:
+    newest = Update.objects.aggregate(newest=Max('created_at'))['newest']
+    version = newest.timestamp() if newest else 0.0
+    cache.set(LAST_MODIFIED_KEY, version, None)
+    return version
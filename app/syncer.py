@@ -1,17 +1,18 @@
-import requests
-from django.conf import settings
-from app.models import Station
+from app.models import Station, ImportStats
+from app.nrel import open_fuel_stations
+from app.caching import STATIONS, bump_tags
 
 
-URL = 'https://developer.nrel.gov/api/alt-fuel-stations/v1.json'
-params = {
-    'fuel_type': 'ELEC',
-    'api_key': settings.NREL_API_KEY,
-    'country': 'all',
-}
-
-
-def sync():
-    data = requests.get(URL, params=params).json()
-    Station.objects.import_from_nrel(data)
-    Station.objects.link_stations()
+def sync(source=None, incremental=False) -> ImportStats:
+    """
+    Imports the NREL feed and links duplicate stations. A full sync also removes stations that have left the
+    feed and relinks every station, while an incremental sync only relinks the address keys it touched.
+    """
+    # the API has no modified-since filter, so both kinds download the whole feed; unchanged stations are cheap
+    # to skip by their fingerprint
+    with open_fuel_stations(source) as stations:
+        stats = Station.objects.import_from_nrel(stations, reconcile=not incremental)
+    Station.objects.link_stations(stats.address_keys if incremental else None)
+    if stats.created or stats.updated or stats.deleted:
+        bump_tags(STATIONS)
+    return stats
@@ -4,15 +4,10 @@ from django.apps import apps
 from celery import shared_task
 from celery.utils.log import get_task_logger
 from discord_webhook import DiscordWebhook, DiscordEmbed
+from app.nrel import URL
 
 
 logging = get_task_logger(__name__)
-URL = 'https://developer.nrel.gov/api/alt-fuel-stations/v1.json'
-params = {
-    'fuel_type': 'ELEC',
-    'api_key': settings.NREL_API_KEY,
-    'country': 'all',
-}
 
 
 @shared_task(
@@ -23,29 +18,38 @@ params = {
         "max_retries": 3,
     },
 )
-def sync_fuel_stations(task):
+def sync_fuel_stations(task, source=None, incremental=False):
+    """
+    Syncs stations from the NREL feed. An incremental sync skips removing missing stations and relinking
+    unchanged ones, but downloads the same whole feed as a full sync.
+    """
     if task.request.retries > 0:
         logging.info(
             "[Task Retry] attempt %d/%d",
             task.request.retries,
             task.retry_kwargs["max_retries"],
         )
-    logging.info("[Started] scraping data from %s ....", URL)
-    Station = apps.get_model("app", "Station")
-    data = requests.get(URL, params=params).json()
-    logging.info('[Progress] got %d stations from NREL', len(data.get('fuel_stations', [])))
-    stats = Station.objects.import_from_nrel(data)
-    Station.objects.link_stations()
-    logging.info("[Completed] scrape %d created %d updated %d skipped", stats.created, stats.updated, stats.skipped)
+    from app.syncer import sync
+    logging.info("[Started] %s scraping data from %s ....", 'incremental' if incremental else 'full', source or URL)
+    stats = sync(source, incremental=incremental)
+    logging.info(
+        "[Completed] scrape %d created %d updated %d skipped %d deleted",
+        stats.created, stats.updated, stats.skipped, stats.deleted
+    )
+    if stats.withheld:
+        logging.warning("[Withheld] %d stations missing from the feed were not deleted", stats.withheld)
     return {
         'created': stats.created,
         'updated': stats.updated,
         'skipped': stats.skipped,
+        'deleted': stats.deleted,
+        'withheld': stats.withheld,
     }
 
 
 @shared_task
 def publish_update(update_id):
+    from app.response_cache import invalidate_response_cache
     Update = apps.get_model("app", "Update")
     Search = apps.get_model("beacon", "Search")
     update = Update.objects.get(id=update_id)
@@ -53,12 +57,30 @@ def publish_update(update_id):
     logging.info("[Published] %d searches %d errors for update %s", n_published, len(errors), update_id)
     for error in errors:
         logging.error("[Publish Error] search publish error %s", error.id)
+    invalidate_response_cache()
     return {
         'published': n_published,
         'errors': len(errors),
     }
 
 
+@shared_task
+def publish_updates(update_ids):
+    from app.models import chunked
+    from app.response_cache import invalidate_response_cache
+    Update = apps.get_model("app", "Update")
+    Search = apps.get_model("beacon", "Search")
+    n_published = 0
+    for ids in chunked(update_ids, 1000):
+        n_published += Search.objects.publish_many(Update.objects.filter(id__in=ids).select_related('station'))
+    invalidate_response_cache()
+    logging.info("[Published] %d search results for %d updates", n_published, len(update_ids))
+    return {
+        'published': n_published,
+        'updates': len(update_ids),
+    }
+
+
 @shared_task
 def event(name, message, data):
     logging.info("[Event] %s %s %s", name, message, data)
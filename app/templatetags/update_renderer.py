@@ -1,5 +1,5 @@
 from django import template
-from app.renderer import get_changes, render_field
+from app.renderer import render_field, render_update_fragment
 
 
 register = template.Library()
@@ -12,7 +12,7 @@ def station_card(update):
         'station': update.station,
         'new': update.is_creation,
         'timestamp': update.created_at,
-        'changes': get_changes(update)
+        'body': render_update_fragment('app/station_card_body.html', update),
     }
 
 
@@ -9,7 +9,14 @@ def url_params(context, **kwargs):
     if 'request' not in context:
         raise ValueError('url_params requires request in context')
     safe_args = context['request'].GET.copy()
-    safe_args.update({k: v for k, v in kwargs.items() if v is not None})
+    for k, v in kwargs.items():
+        if v is None:
+            continue
+        if v == '':
+            # an empty value removes the parameter
+            safe_args.pop(k, None)
+        else:
+            safe_args[k] = v
     if safe_args:
         return '?{}'.format(urlencode(safe_args))
     return ''
@@ -1,8 +1,11 @@
 import os
 import json
+from unittest import mock
 from django.test import TestCase
 from django.utils import dateparse
-from app.models import Station, Update
+from app.models import Station, Update, get_beacon_names
+from app.renderer import get_changes, Change
+from beacon.models import Area, AreaType
 
 
 class SyncingTest(TestCase):
@@ -50,6 +53,139 @@ class SyncingTest(TestCase):
         # verify beacon name not updated
         self.assertEqual(station.beacon_name, og_beacon_name)
 
+    def test_sync_stores_changes(self):
+        Station.objects.import_from_nrel(_get_sync_data())
+        Station.objects.import_from_nrel(_get_sync_data(updated_at='2024-01-16T01:56:49Z', status_code='T'))
+        self.assertEqual(Update.objects.get(is_creation=True).changes, [])
+        update = Update.objects.get(is_creation=False)
+        self.assertEqual(update.changes, [['status_code', 'Available', 'Temporarily Unavailable']])
+        with mock.patch('app.renderer.diff') as diff:
+            changes = get_changes(update)
+        diff.assert_not_called()
+        self.assertEqual(changes, [
+            Change('change', 'status_code', 'Status Code', 'Available', 'Temporarily Unavailable')
+        ])
+
+    def test_batches_published_as_they_commit(self):
+        names = get_beacon_names
+
+        def fail_second_batch(n):
+            if fail_second_batch.calls:
+                raise ValueError('stream dropped')
+            fail_second_batch.calls += 1
+            return names(n)
+
+        fail_second_batch.calls = 0
+        with mock.patch('app.models.publish_updates') as publish_updates, \
+                mock.patch('app.models.get_beacon_names', fail_second_batch), \
+                self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValueError):
+                Station.objects.import_from_nrel(load_test_stations(), batch_size=10)
+        publish_updates.delay.assert_called_once()
+        self.assertEqual(len(publish_updates.delay.call_args.args[0]), 10)
+        self.assertEqual(set(publish_updates.delay.call_args.args[0]), set(Update.objects.values_list('id', flat=True)))
+
+    def test_sync_in_batches(self):
+        stats = Station.objects.import_from_nrel(load_test_stations(), batch_size=10)
+        self.assertEqual(stats.created, 48)
+        self.assertEqual(Station.objects.count(), 48)
+        self.assertEqual(Station.history.count(), 48)
+        self.assertEqual(Update.objects.filter(is_creation=True).count(), 48)
+        self.assertEqual(len(set(Station.objects.values_list('beacon_name', flat=True))), 48)
+
+        data = load_test_stations()
+        for station in data['fuel_stations'][:5]:
+            station['status_code'] = 'T'
+        stats = Station.objects.import_from_nrel(data, batch_size=10)
+        self.assertEqual(stats.created, 0)
+        self.assertEqual(stats.updated, 5)
+        self.assertEqual(stats.skipped, 43)
+        self.assertEqual(Station.history.count(), 53)
+        self.assertEqual(Station.objects.filter(status_code='T').count(), 5)
+        for update in Update.objects.filter(is_creation=False):
+            self.assertEqual(update.current['status_code'], 'T')
+            self.assertNotEqual(update.previous['status_code'], 'T')
+
+    def test_sync_skips_unchanged_fingerprint(self):
+        Station.objects.import_from_nrel(load_test_stations())
+        self.assertFalse(Station.objects.filter(nrel_hash__isnull=True).exists())
+        with mock.patch('app.models.clean_station_json') as clean:
+            stats = Station.objects.import_from_nrel(load_test_stations())
+        clean.assert_not_called()
+        self.assertEqual(stats.skipped, 48)
+        self.assertEqual(Update.objects.count(), 48)
+
+    def test_sync_backfills_fingerprint(self):
+        Station.objects.import_from_nrel(_get_sync_data())
+        Station.objects.update(nrel_hash=None)
+        stats = Station.objects.import_from_nrel(_get_sync_data())
+        self.assertEqual(stats.skipped, 1)
+        self.assertEqual(Update.objects.count(), 1)
+        self.assertEqual(Station.history.count(), 1)
+        self.assertIsNotNone(Station.objects.first().nrel_hash)
+
+    def test_sync_reverts_edits_made_outside_the_importer(self):
+        Station.objects.import_from_nrel(_get_sync_data())
+        station = Station.objects.first()
+        imported_name = station.station_name
+        station.station_name = 'Edited in the admin'
+        station.save()
+        self.assertTrue(station.nrel_hash.startswith('edited:'))
+
+        stats = Station.objects.import_from_nrel(_get_sync_data())
+        self.assertEqual(stats.skipped, 0)
+        station.refresh_from_db()
+        self.assertEqual(station.station_name, imported_name)
+        self.assertFalse(station.nrel_hash.startswith('edited:'))
+
+    def test_sync_incremental_keeps_older_records(self):
+        Station.objects.import_from_nrel(load_test_stations())
+        data = load_test_stations()
+        late = data['fuel_stations'][0]
+        Station.objects.filter(id=late['id']).delete()
+        late.update(updated_at='2020-01-01T00:00:00Z')
+        stats = Station.objects.import_from_nrel(data)
+        self.assertEqual(stats.created, 1)
+        self.assertTrue(Station.objects.filter(id=late['id']).exists())
+
+    def test_sync_reconcile_deletes_missing(self):
+        Station.objects.import_from_nrel(load_test_stations())
+        stats = Station.objects.import_from_nrel(_get_sync_data(), reconcile=True, max_deleted_ratio=1)
+        self.assertEqual(stats.deleted, 47)
+        self.assertEqual(Station.objects.count(), 1)
+
+    def test_sync_reconcile_withholds_mass_deletion(self):
+        Station.objects.import_from_nrel(load_test_stations())
+        stats = Station.objects.import_from_nrel(_get_sync_data(), reconcile=True)
+        self.assertEqual(stats.deleted, 0)
+        self.assertEqual(stats.withheld, 47)
+        self.assertEqual(Station.objects.count(), 48)
+
+    def test_sync_assigns_areas(self):
+        area = Area.objects.create(
+            name='Oregon-ish', place_id='or-ish', area_type=AreaType.STATE,
+            geom='MULTIPOLYGON(((-122 45, -120 45, -120 46, -122 46, -122 45)))'
+        )
+        Station.objects.import_from_nrel(_get_sync_data())
+        station = Station.objects.first()
+        self.assertEqual(list(station.areas.all()), [area])
+        self.assertEqual(Update.objects.feed(areas=[area.id]).count(), 1)
+
+        Station.objects.import_from_nrel(_get_sync_data(latitude=40.0, longitude=-100.0))
+        self.assertFalse(station.areas.exists())
+        self.assertEqual(Update.objects.feed(areas=[area.id]).count(), 0)
+
+    def test_save_refreshes_areas(self):
+        area = Area.objects.create(
+            name='Oregon-ish', place_id='or-ish', area_type=AreaType.STATE,
+            geom='MULTIPOLYGON(((-122 45, -120 45, -120 46, -122 46, -122 45)))'
+        )
+        station = Station.objects.create(id=1, point='POINT(-121 45.5)')
+        self.assertEqual(list(station.areas.all()), [area])
+        station.point = 'POINT(-100 40)'
+        station.save()
+        self.assertFalse(station.areas.exists())
+
     def test_link_stations(self):
         Station.objects.import_from_nrel(load_test_stations())
         Station.objects.link_stations()
@@ -57,6 +193,23 @@ class SyncingTest(TestCase):
         unlinked = Station.objects.filter(linked_to__isnull=True)
         self.assertEqual(unlinked.count(), 8)
 
+    def test_link_stations_incremental(self):
+        stats = Station.objects.import_from_nrel(load_test_stations())
+        Station.objects.link_stations(stats.address_keys)
+        self.assertEqual(Station.objects.primaries().count(), 8)
+
+        # moving a linked station to a new address makes it a primary again
+        linked = Station.objects.exclude(linked_to=None).first()
+        data = load_test_stations()
+        for station in data['fuel_stations']:
+            if station['id'] == linked.id:
+                station['street_address'] = '1 Nowhere Lane'
+        stats = Station.objects.import_from_nrel(data)
+        self.assertEqual(len(stats.address_keys), 2)
+        Station.objects.link_stations(stats.address_keys)
+        self.assertIsNone(Station.objects.get(id=linked.id).linked_to)
+        self.assertEqual(Station.objects.primaries().count(), 9)
+
 
 def _get_sync_data(**updates):
     station = load_test_stations()['fuel_stations'][-1]
@@ -64,7 +217,10 @@ def _get_sync_data(**updates):
     return {'fuel_stations': [station]}
 
 
+def stations_fixture_path():
+    return os.path.join(os.path.dirname(__file__), 'testdata', 'stations.json')
+
+
 def load_test_stations():
-    f = os.path.join(os.path.dirname(__file__), 'testdata', 'stations.json')
-    with open(f) as f:
+    with open(stations_fixture_path()) as f:
         return json.load(f)
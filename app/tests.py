@@ -1,3 +1,313 @@
-from django.test import TestCase
+import io
+import json
+import time
+from datetime import timedelta
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from app.caching import AREAS, STATIONS, bump_tags, cached, local_cache
+from app.models import Station, Update
+from app.nrel import iter_fuel_stations, open_fuel_stations
+from app.pagination import KeysetPaginator
+from app.renderer import render_update_fragment
+from app.response_cache import invalidate_response_cache
+from app.views import CustomFeed
+from app.test_models import load_test_stations, stations_fixture_path
 
-# Create your tests here.
+
+class NRELStreamTest(TestCase):
+    def test_iter_fuel_stations(self):
+        with open(stations_fixture_path(), 'rb') as f:
+            stations = list(iter_fuel_stations(f, chunk_size=7))
+        self.assertEqual(stations, load_test_stations()['fuel_stations'])
+
+    def test_iter_fuel_stations_skips_other_keys(self):
+        doc = {'total_results': 2, 'fuel_stations': [{'id': 1, 'city': 'Montréal'}, {'id': 2}], 'precision': {}}
+        f = io.BytesIO(json.dumps(doc, ensure_ascii=False).encode('utf-8'))
+        self.assertEqual(list(iter_fuel_stations(f, chunk_size=3)), doc['fuel_stations'])
+
+    def test_import_from_fixture_source(self):
+        with open_fuel_stations(stations_fixture_path()) as stations:
+            stats = Station.objects.import_from_nrel(stations, batch_size=10)
+        self.assertEqual(stats.created, 48)
+        self.assertEqual(Update.objects.count(), 48)
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        station = Station.objects.create(id=1337)
+        now = timezone.now()
+        for i in range(8):
+            update = Update.objects.create(station=station)
+            # pairs of updates share a timestamp so ties are broken by id
+            Update.objects.filter(id=update.id).update(created_at=now - timedelta(minutes=i // 2))
+        self.expected = list(Update.objects.order_by('-created_at', '-id'))
+
+    def test_pages_forward_and_back(self):
+        paginator = KeysetPaginator(Update.objects.all(), 3)
+        pages = [paginator.get_page()]
+        while pages[-1].has_next():
+            pages.append(paginator.get_page(before=pages[-1].next_cursor()))
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual([u for page in pages for u in page], self.expected)
+        self.assertFalse(pages[0].has_previous())
+
+        previous = paginator.get_page(after=pages[-1].previous_cursor())
+        self.assertEqual(list(previous), list(pages[1]))
+        self.assertTrue(previous.has_previous())
+        self.assertTrue(previous.has_next())
+
+    def test_last_page(self):
+        page = KeysetPaginator(Update.objects.all(), 3).get_page(last=True)
+        self.assertEqual(list(page), self.expected[-3:])
+        self.assertFalse(page.has_next())
+        self.assertTrue(page.has_previous())
+
+    def test_invalid_cursor(self):
+        page = KeysetPaginator(Update.objects.all(), 3).get_page(before='garbage')
+        self.assertEqual(list(page), self.expected[:3])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class StationCardFragmentTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        Station.objects.import_from_nrel(load_test_stations())
+        self.update = Update.objects.select_related('station').first()
+
+    def test_fragment_is_cached(self):
+        html = render_update_fragment('app/station_card_body.html', self.update)
+        with mock.patch('app.renderer.get_template') as get_template:
+            self.assertEqual(render_update_fragment('app/station_card_body.html', self.update), html)
+        get_template.assert_not_called()
+
+    def test_station_change_busts_fragment(self):
+        render_update_fragment('app/station_card_body.html', self.update)
+        self.update.station.nrel_hash = 'changed'
+        with mock.patch('app.renderer.get_template') as get_template:
+            get_template.return_value.render.return_value = '<div></div>'
+            self.assertEqual(render_update_fragment('app/station_card_body.html', self.update), '<div></div>')
+        get_template.assert_called_once()
+
+    def test_station_save_busts_fragment(self):
+        station = self.update.station
+        for evse_num in [4321, 8765]:
+            station.ev_level2_evse_num = evse_num
+            station.save()
+            self.assertIn(str(evse_num), render_update_fragment('app/station_card_body.html', self.update))
+
+    def test_feed_renders_cached_body(self):
+        res = self.client.get('/updates/feed')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Plug Types', res.content.decode())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        Station.objects.import_from_nrel(load_test_stations())
+
+    def test_cached_until_published(self):
+        first = self.client.get('/updates_partial', {'ev_network': 'Tesla', 'dc_fast': 'true'})
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('ETag', first)
+
+        with mock.patch('app.views.get_updates_context') as get_updates_context:
+            second = self.client.get('/updates_partial', {'dc_fast': 'true', 'ev_network': 'Tesla', 'only_new': ''})
+        get_updates_context.assert_not_called()
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+        Update.objects.create(station=Station.objects.first())
+        invalidate_response_cache()
+        third = self.client.get('/updates_partial', {'ev_network': 'Tesla', 'dc_fast': 'true'})
+        self.assertNotEqual(third['ETag'], first['ETag'])
+
+    def test_not_modified(self):
+        first = self.client.get('/updates/feed')
+        res = self.client.get('/updates/feed', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(res.status_code, 304)
+        res = self.client.get('/updates/feed', HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(res.status_code, 304)
+
+    def test_authenticated_bypasses_cache(self):
+        user = get_user_model().objects.create_user('reader', 'reader@example.com', 'password')
+        self.client.force_login(user)
+        res = self.client.get('/updates_partial')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('ETag', res)
+
+
+class FeedConditionalGetTest(TestCase):
+    def setUp(self):
+        Station.objects.import_from_nrel(load_test_stations())
+        self.slow = Station.objects.first()
+        Station.objects.filter(id=self.slow.id).update(ev_dc_fast_num=0)
+
+    def test_not_modified_until_matching_update(self):
+        user = get_user_model().objects.create_user('reader', 'reader@example.com', 'password')
+        self.client.force_login(user)
+        first = self.client.get('/updates/feed', {'dc_fast': 'true'})
+        self.assertEqual(first.status_code, 200)
+
+        with mock.patch.object(CustomFeed, 'get_feed') as get_feed:
+            res = self.client.get('/updates/feed', {'dc_fast': 'true'}, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(res.status_code, 304)
+        get_feed.assert_not_called()
+
+        # an update to a station outside the filter leaves the feed unchanged
+        Update.objects.create(station=self.slow)
+        res = self.client.get('/updates/feed', {'dc_fast': 'true'}, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(res.status_code, 304)
+
+        Update.objects.create(station=Station.objects.exclude(id=self.slow.id).first())
+        res = self.client.get('/updates/feed', {'dc_fast': 'true'}, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res['ETag'], first['ETag'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class StationTileTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        Station.objects.import_from_nrel(load_test_stations())
+
+    def test_tile(self):
+        res = self.client.get('/tiles/0/0/0.mvt')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertGreater(len(res.content), 0)
+
+        with mock.patch('app.tile_views.render_tile') as render_tile:
+            cached = self.client.get('/tiles/0/0/0.mvt')
+        render_tile.assert_not_called()
+        self.assertEqual(cached.content, res.content)
+
+    def test_invalid_tile(self):
+        self.assertEqual(self.client.get('/tiles/1/2/0.mvt').status_code, 404)
+
+
+class StationsInBoundsTest(TestCase):
+    def setUp(self):
+        Station.objects.import_from_nrel(load_test_stations())
+
+    def test_points(self):
+        res = self.client.get('/geojson/stations', {'bounds': '-180,-90,180,90'})
+        features = json.loads(b''.join(res.streaming_content))['features']
+        self.assertEqual(len(features), Station.objects.exclude(point=None).count())
+        self.assertEqual(set(features[0]['properties']), {'beacon_name', 'ev_dc_fast_num'})
+        station = Station.objects.get(id=features[0]['id'])
+        self.assertEqual(features[0]['properties']['beacon_name'], station.beacon_name)
+        self.assertAlmostEqual(features[0]['geometry']['coordinates'][0], station.point.x, places=5)
+
+    def test_filters_and_limit(self):
+        station = Station.objects.exclude(point=None).first()
+        res = self.client.get('/geojson/stations', {'bounds': '-180,-90,180,90', 'ev_network': station.ev_network})
+        collection = json.loads(b''.join(res.streaming_content))
+        expected = Station.objects.exclude(point=None).filter(ev_network=station.ev_network).count()
+        self.assertEqual(len(collection['features']), expected)
+        self.assertFalse(collection['truncated'])
+
+        res = self.client.get('/geojson/stations', {'bounds': '-180,-90,180,90', 'limit': '5'})
+        collection = json.loads(b''.join(res.streaming_content))
+        self.assertEqual(len(collection['features']), 5)
+        self.assertTrue(collection['truncated'])
+
+        res = self.client.get('/geojson/stations', {'bounds': '-180,-90,180,90', 'limit': '-5'})
+        self.assertEqual(res.status_code, 400)
+
+    def test_clusters(self):
+        res = self.client.get('/geojson/stations', {'bounds': '-180,-90,180,90', 'zoom': '2'})
+        features = res.json()['features']
+        self.assertLess(len(features), Station.objects.exclude(point=None).count())
+        self.assertEqual(sum(f['properties']['count'] for f in features), Station.objects.exclude(point=None).count())
+        self.assertTrue(all(f['properties']['cluster'] for f in features))
+
+    def test_invalid_zoom(self):
+        for zoom in ['-inf', '-2000', '-1e308', 'nan', '23']:
+            res = self.client.get('/geojson/stations', {'bounds': '-180,-90,180,90', 'zoom': zoom})
+            self.assertEqual(res.status_code, 400)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CachedTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.calls = []
+
+        @cached(60, key='test_cached')
+        def lookup(*args):
+            self.calls.append(args)
+            return []
+
+        self.lookup = lookup
+
+    def test_keyed_on_arguments(self):
+        self.lookup(1)
+        self.lookup(1)
+        self.lookup(2)
+        self.lookup(Station.objects.filter(id=1))
+        self.lookup(Station.objects.filter(id=2))
+        self.assertEqual(len(self.calls), 4)
+
+    def test_empty_results_are_cached(self):
+        self.assertEqual(self.lookup('x'), [])
+        local_cache.clear()
+        self.assertEqual(self.lookup('x'), [])
+        self.assertEqual(len(self.calls), 1)
+
+    def test_stale_served_while_refreshing(self):
+        self.lookup('x')
+        local_cache.clear()
+        # another process holds the lock and is recomputing the expired entry
+        with mock.patch('app.caching.time.time', return_value=time.time() + 90), \
+                mock.patch.object(cache, 'add', return_value=False):
+            self.assertEqual(self.lookup('x'), [])
+        self.assertEqual(len(self.calls), 1)
+
+        with mock.patch('app.caching.time.time', return_value=time.time() + 90):
+            self.lookup('x')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_waiter_keeps_holders_lock(self):
+        # another process holds the lock and never finishes, so this call gives up waiting and computes
+        with mock.patch('app.caching.wait_for', return_value=None), \
+                mock.patch.object(cache, 'add', return_value=False), \
+                mock.patch.object(cache, 'delete') as delete:
+            self.assertEqual(self.lookup('x'), [])
+        self.assertEqual(len(self.calls), 1)
+        delete.assert_not_called()
+
+    def test_invalidate(self):
+        self.lookup('x')
+        self.lookup.invalidate('x')
+        self.lookup('x')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_tags(self):
+        @cached(60, key='test_tagged', tags=[STATIONS])
+        def tagged():
+            self.calls.append(())
+
+        tagged()
+        tagged()
+        bump_tags(AREAS)
+        tagged()
+        self.assertEqual(len(self.calls), 1)
+        bump_tags(STATIONS)
+        tagged()
+        self.assertEqual(len(self.calls), 2)
+
+    def test_network_counts_follow_syncs(self):
+        Station.objects.import_from_nrel(load_test_stations())
+        Station.objects.link_stations()
+        networks = Station.objects.all_networks()
+        with self.assertNumQueries(0):
+            self.assertEqual(Station.objects.all_networks(), networks)
+
+        Station.objects.create(id=4242, ev_network='Brand New Network', beacon_name='brand-new')
+        self.assertIn('Brand New Network', [n['id'] for n in Station.objects.all_networks()])
@@ -0,0 +1,53 @@
+from django.core.cache import cache
+from django.db import connection
+from django.http import Http404, HttpResponse
+from app.caching import STATIONS, tag_versions
+
+
+TILE_TIMEOUT = 60 * 60 * 24 * 30
+MAX_ZOOM = 22
+
+# the attributes carried by each feature, slimmed down as the map zooms out and features get dense
+TILE_COLUMNS = [
+    (12, ('beacon_name', 'station_name', 'ev_network', 'ev_dc_fast_num')),
+    (8, ('beacon_name', 'ev_dc_fast_num')),
+    (0, ('ev_dc_fast_num',)),
+]
+
+TILE_SQL = '''
+WITH bounds AS (
+    SELECT ST_TileEnvelope(%s, %s, %s) AS geom
+), features AS (
+    SELECT ST_AsMVTGeom(ST_Transform(s.point, 3857), bounds.geom) AS geom, {columns}
+    FROM app_station s, bounds
+    WHERE s.point && ST_Transform(bounds.geom, 4326)
+)
+SELECT ST_AsMVT(features.*, 'stations') FROM features
+'''
+
+
+def station_tile(request, z, x, y):
+    """
+    Serves a Mapbox Vector Tile of the stations within tile z/x/y, built by PostGIS and cached until the next sync.
+    """
+    if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        raise Http404('invalid tile')
+
+    key = f'tile:{tag_versions([STATIONS])}:{z}/{x}/{y}'
+    tile = cache.get(key)
+    if tile is None:
+        tile = render_tile(z, x, y)
+        cache.set(key, tile, TILE_TIMEOUT)
+
+    response = HttpResponse(tile, content_type='application/vnd.mapbox-vector-tile')
+    response['Cache-Control'] = 'public, max-age=900'
+    return response
+
+
+def render_tile(z, x, y) -> bytes:
+    columns = next(columns for min_zoom, columns in TILE_COLUMNS if z >= min_zoom)
+    sql = TILE_SQL.format(columns=', '.join(f's.{column}' for column in columns))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [z, x, y])
+        tile = cursor.fetchone()[0]
+    return bytes(tile) if tile else b''
@@ -1,14 +1,16 @@
 from django.urls import re_path, path, include
 
-from app import views, geojson_views
+from app import views, geojson_views, tile_views
+from app.response_cache import cache_anonymous_response
 
 urlpatterns = [
     path('', views.index, name='index'),
     path('searches', views.searches, name='searches-list'),
     path('searches/new', views.new_search, name='search-new'),
     path('searches/<int:search_id>', views.edit_search, name='search-edit'),
-    path('updates/feed', views.CustomFeed(), name='updates-feed'),
+    path('updates/feed', cache_anonymous_response(views.CustomFeed()), name='updates-feed'),
     path('geojson/stations', geojson_views.stations_in_bounds, name='stations_in_bounds'),
+    path('tiles/<int:z>/<int:x>/<int:y>.mvt', tile_views.station_tile, name='station-tile'),
     re_path(r'station/(?P<beacon_name>[\w_-]+)\.(?P<fmt>json)', views.station, name='station'),
     re_path(r'station/(?P<beacon_name>[\w_-]+)', views.station, name='station', kwargs={'fmt': 'html'}),
     path('updates_partial', views.updates_partial, name='updates_partial'),
@@ -1,36 +1,43 @@
-from django.core.paginator import Paginator
 from django.http import Http404, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.decorators import login_required
 from django.contrib.syndication.views import Feed
 from django.contrib import messages
 from beacon.models import Search, Area
 from beacon.forms import SearchForm
+from app.caching import STATIONS, cached
 from app.models import Station, Update
-from app.renderer import get_changes, render_field
+from app.pagination import KeysetPaginator
+from app.renderer import render_field, render_update_fragment
+from app.response_cache import cache_anonymous_response
 from app.constants import LOOKUPS
 from app.events import CREATE_SEARCH
 
 
+@cache_anonymous_response
 def index(request):
     ctx = get_updates_context(request, search_id=request.GET.get('search_id', None))
     return render(request, 'app/index.html', ctx)
 
 
+@cache_anonymous_response
 def updates_partial(request):
     ctx = get_updates_context(request, search_id=request.GET.get('search_id', None))
     return render(request, 'app/updates_body.html', ctx)
 
 
 def station(request, beacon_name, fmt):
-    item = get_object_or_404(Station, beacon_name=beacon_name)
-
     if fmt == 'json':
-        item_dict = {k: render_field(k, v) for k, v in item.to_dict().items()}
+        if (item_dict := station_json(beacon_name)) is None:
+            raise Http404('No Station matches the given query.')
         return JsonResponse(item_dict)
 
+    item = get_object_or_404(Station, beacon_name=beacon_name)
+
     return render(request, 'app/station.html', {
         'base_uri': f'{request.scheme}://{request.get_host()}',
         'station': item,
@@ -38,13 +45,16 @@ def station(request, beacon_name, fmt):
     })
 
 
+@cached(60 * 60 * 24 * 30, tags=[STATIONS])
+def station_json(beacon_name):
+    if item := Station.objects.filter(beacon_name=beacon_name).first():
+        return {k: render_field(k, v) for k, v in item.to_dict().items()}
+    return None
+
+
 @login_required
 def searches(request):
-    saved = (
-        Search.objects.filter(user=request.user)
-        .order_by('name')
-        .with_unread_count()
-    )
+    saved = Search.objects.filter(user=request.user).order_by('name')
     return render(request, 'app/search/list.html', {
         'searches': saved
     })
@@ -169,13 +179,17 @@ def get_updates_context(request, search_id=None):
     if user_max_results := request.GET.get('max_results', None):
         max_results = int(user_max_results)
 
-    paginator = Paginator(queryset, max_results)
+    paginator = KeysetPaginator(queryset, max_results)
     base_uri = f'{request.scheme}://{request.get_host()}'
 
     ctx.update({
         'base_uri': base_uri,
         'queryset': queryset,
-        'updates': paginator.get_page(request.GET.get('page', '1')),
+        'updates': paginator.get_page(
+            before=request.GET.get('before', None),
+            after=request.GET.get('after', None),
+            last=request.GET.get('last', None) == 'true',
+        ),
         'feed_url': f'{base_uri}{reverse("updates-feed")}?{request.GET.urlencode()}',
         'pagination': request.GET.get('pagination', 'true') == 'true'
     })
@@ -193,12 +207,34 @@ class CustomFeed(Feed):
     link = "/updates/"
     description_template = 'app/station_card_feed.html'
 
+    def __call__(self, request, *args, **kwargs):
+        """
+        Answers conditional requests from the newest matching update alone, so feed readers polling an unchanged
+        feed get a 304 without the items being fetched and rendered.
+        """
+        newest = (
+            get_updates_context(request)['queryset']
+            .order_by('-created_at', '-id')
+            .values_list('id', 'created_at')
+            .first()
+        )
+        etag = f'"feed-{newest[0]}-{newest[1].timestamp()}"' if newest else '"feed-empty"'
+        last_modified = int(newest[1].timestamp()) if newest else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().__call__(request, *args, **kwargs)
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
     def get_object(self, request, *args, **kwargs):
         ctx = get_updates_context(request)
         return ctx
 
     def items(self, obj):
-        return obj['queryset'][:100]
+        return obj['queryset'].order_by('-created_at', '-id')[:100]
 
     def link(self, obj):
         return obj['feed_url']
@@ -211,7 +247,7 @@ class CustomFeed(Feed):
         ctx['station'] = item.station
         ctx['new'] = item.is_creation
         ctx['timestamp'] = item.created_at
-        ctx['changes'] = get_changes(item)
+        ctx['body'] = render_update_fragment('app/station_card_feed_body.html', item)
         return ctx
 
     def item_link(self, item):
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class BeaconConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'beacon'
+
+    def ready(self):
+        from beacon import signals  # noqa: F401
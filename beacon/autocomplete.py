@@ -0,0 +1,85 @@
+from bisect import bisect_left
+from collections import defaultdict
+from app.caching import AREAS, tag_versions
+from beacon.models import Area, AreaType
+
+
+RESULT_LIMIT = 100
+# completions are ranked by area type in this order, then by name
+RANKED_TYPES = [AreaType.STATE, AreaType.ZIP]
+
+_index = None
+
+
+class AreaIndex:
+    """
+    An in-memory index of area names answering autocomplete queries without the database. Each ranked area
+    type keeps a sorted array of lowercased names that a prefix is binary searched into.
+    """
+
+    def __init__(self, areas, version=None):
+        self.version = version
+        self.areas = {}
+        by_type = defaultdict(list)
+        for area_id, name, area_type in areas:
+            self.areas[area_id] = (name, area_type)
+            if area_type in RANKED_TYPES:
+                by_type[area_type].append((name.lower(), name, area_id))
+
+        self.keys = {}
+        self.entries = {}
+        for area_type in RANKED_TYPES:
+            entries = sorted(by_type[area_type])
+            self.keys[area_type] = [key for key, _, _ in entries]
+            self.entries[area_type] = [(area_id, name) for _, name, area_id in entries]
+
+    @classmethod
+    def build(cls, version=None):
+        return cls(Area.objects.values_list('id', 'name', 'area_type').iterator(chunk_size=5000), version)
+
+    def complete(self, query: str, limit=RESULT_LIMIT) -> list[tuple[int, str]]:
+        """
+        Returns `(id, name)` of the areas whose name starts with `query`, or of the states when there is no query.
+        """
+        if not query:
+            return self.entries[AreaType.STATE][:limit]
+
+        query = query.lower()
+        results = []
+        for area_type in RANKED_TYPES:
+            keys = self.keys[area_type]
+            i = bisect_left(keys, query)
+            while i < len(keys) and len(results) < limit and keys[i].startswith(query):
+                results.append(self.entries[area_type][i])
+                i += 1
+        return results
+
+    def rank(self, area_id) -> tuple[int, str]:
+        name, area_type = self.areas[area_id]
+        rank = RANKED_TYPES.index(area_type) if area_type in RANKED_TYPES else len(RANKED_TYPES)
+        return rank, name.lower()
+
+
+def complete_areas(query: str, selected: set[str]) -> list[tuple[int, str]]:
+    """
+    Returns the completions for `query` along with any `selected` areas that rank within the limit.
+    """
+    index = get_area_index()
+    areas = index.complete(query)
+    found = {str(area_id) for area_id, _ in areas}
+    extra = [int(area_id) for area_id in selected - found if area_id.isdigit() and int(area_id) in index.areas]
+    if extra:
+        areas += [(area_id, index.areas[area_id][0]) for area_id in extra]
+        areas.sort(key=lambda area: index.rank(area[0]))
+    return areas[:RESULT_LIMIT]
+
+
+def get_area_index() -> AreaIndex:
+    """
+    Returns this process's area index, rebuilding it when the areas cache tag has been bumped.
+    """
+    global _index
+    version = tag_versions([AREAS])
+    if _index is None or _index.version != version:
+        _index = AreaIndex.build(version)
+    return _index
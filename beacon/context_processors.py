@@ -6,12 +6,13 @@ search_limit = 5
 def searches(request):
     ret = {}
     if request.user.is_authenticated:
-        search_count = Search.objects.filter(user=request.user).count()
+        # users have a handful of searches, so one query for all of them also gives the count
+        searches = list(
+            Search.objects.filter(user=request.user).order_by('-created').only('id', 'name', 'unread_count')
+        )
         ret = {
-            'searches': (Search.objects.filter(user=request.user)
-                         .order_by('-created')
-                         .with_unread_count()[:search_limit]),
-            'searches_count': search_count,
-            'has_more_searches': search_count > search_limit
+            'searches': searches[:search_limit],
+            'searches_count': len(searches),
+            'has_more_searches': len(searches) > search_limit
         }
     return ret
@@ -1,15 +1,29 @@
+import re
+from collections import defaultdict
 from dataclasses import dataclass
 from datetime import datetime
 from django.conf import settings
 from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
 from django.template.loader import get_template
+from django.utils.html import format_html
 from django.contrib.sites.models import Site
-from css_inline import inline as inline_css
+from css_inline import inline as inline_css, inline_many
+from celery.utils.log import get_task_logger
 from beacon.models import Search, SearchResult, Notification
 from app.models import Station, Update
 from app.renderer import get_changes, Change
 
 
+# the cards' placeholders and wrappers are elements, which escaped user text such as a search name cannot forge
+PLACEHOLDER_RE = re.compile(r'<rollup-update data-id="(\d+)"[^>]*></rollup-update>')
+CARD_RE = re.compile(r'<rollup-card[^>]*>(.*)</rollup-card>', re.S)
+STYLE_RE = re.compile(r'<style[^>]*>.*?</style>', re.S | re.I)
+
+logging = get_task_logger(__name__)
+
+
 @dataclass
 class Result:
     station: Station
@@ -17,55 +31,118 @@ class Result:
     changes: list[Change]
     result: SearchResult
 
+    @property
+    def placeholder(self):
+        return format_html('<rollup-update data-id="{}"></rollup-update>', self.update.id)
 
-def create_email_notification(search_id: int, time_range: str, timestamp: datetime) -> int:
-    with transaction.atomic():
-        search = Search.objects.get(id=search_id)
-        results = SearchResult.objects.filter(
-            search_id=search_id,
-            created_at__gt=search.last_notified_timestamp,
-        ).select_related('update', 'update__station').order_by('-created_at')
-
-        if not len(results):
-            return -1
-
-        search.last_notified_timestamp = results[0].created_at
-        search.save()
-
-        body_tmpl = get_template('beacon/emails/search_roll_up.html')
-        body_text_tmpl = get_template('beacon/emails/search_roll_up.txt')
-        subject_tmpl = get_template('beacon/emails/search_roll_up_subject.txt')
-        url_scheme = 'https' if settings.DEBUG else 'http'
-        site = Site.objects.get_current()
-        result_objs = [
-            Result(
-                station=result.update.station,
-                update=result.update,
-                changes=get_changes(result.update),
-                result=result,
-            )
-            for result in results
-        ]
+
+class RollupRenderer:
+    """
+    Renders rollup emails for a batch of searches. The templates and site are loaded once, and each update's
+    changes and CSS-inlined card are rendered once no matter how many of the batch's emails include it.
+    Each email is inlined without its cards, which are then dropped into place.
+    """
+
+    def __init__(self, time_range: str):
+        self.time_range = time_range
+        self.body_tmpl = get_template('beacon/emails/search_roll_up.html')
+        self.body_text_tmpl = get_template('beacon/emails/search_roll_up.txt')
+        self.subject_tmpl = get_template('beacon/emails/search_roll_up_subject.txt')
+        self.result_tmpl = get_template('beacon/emails/search_roll_up_result.html')
+        self.url_scheme = 'https' if settings.DEBUG else 'http'
+        self.site = Site.objects.get_current()
+        self.base_url = f'{self.url_scheme}://{self.site.domain}'
+        self.changes = {}
+        self.fragments = {}
+        self.styles = None
+
+    def render(self, search: Search, results: list[SearchResult]) -> dict:
+        result_objs = [self.result(result) for result in results]
         ctx = {
             'search': search,
             'results': result_objs,
-            'result_count': results.count(),
-            'time_range': time_range,
-            'url_scheme': url_scheme,
-            'site': site,
-            'base_url': f'{url_scheme}://{site.domain}',
+            'result_count': len(results),
+            'time_range': self.time_range,
+            'url_scheme': self.url_scheme,
+            'site': self.site,
+            'base_url': self.base_url,
         }
+        body_html = self.body_tmpl.render(ctx)
+        if self.styles is None:
+            # the cards are inlined against the same stylesheet as the email around them
+            self.styles = ''.join(STYLE_RE.findall(body_html))
+        self.render_fragments(result_objs)
+        body_html = PLACEHOLDER_RE.sub(lambda m: self.fragments.get(int(m[1]), m[0]), inline_css(body_html))
+        return {
+            'subject': self.subject_tmpl.render(ctx).strip(),
+            'body': self.body_text_tmpl.render(ctx),
+            'body_html': body_html,
+            'recipient': search.user.email
+        }
+
+    def result(self, result: SearchResult) -> Result:
+        update = result.update
+        if update.id not in self.changes:
+            self.changes[update.id] = get_changes(update)
+        return Result(station=update.station, update=update, changes=self.changes[update.id], result=result)
+
+    def render_fragments(self, results: list[Result]):
+        missing = {result.update.id: result for result in results if result.update.id not in self.fragments}
+        if not missing:
+            return
+        # the stylesheet's body rules restyle the <body> tag, so each card is taken back out of its own wrapper
+        documents = [
+            f'<html><head>{self.styles}</head><body><rollup-card>'
+            f'{self.result_tmpl.render({"result": result, "base_url": self.base_url})}'
+            f'</rollup-card></body></html>'
+            for result in missing.values()
+        ]
+        for update_id, inlined in zip(missing, inline_many(documents)):
+            self.fragments[update_id] = CARD_RE.search(inlined)[1]
+
+
+def create_email_notification(search_id: int, time_range: str, timestamp: datetime) -> int:
+    notification_ids = create_email_notifications([search_id], time_range, timestamp)
+    return notification_ids[0] if notification_ids else -1
+
+
+def create_email_notifications(search_ids: list[int], time_range: str, timestamp: datetime) -> list[int]:
+    """
+    Creates the rollup notifications for a batch of searches, fetching the unread results of all of them in one
+    query. Searches without unread results are skipped, and one that fails is logged without holding up the rest.
+    Returns the ids of the notifications created.
+    """
+    results = defaultdict(list)
+    unread = SearchResult.objects.filter(
+        search_id__in=search_ids,
+        created_at__gt=F('search__last_notified_timestamp'),
+    ).select_related('update', 'update__station').order_by('-created_at')
+    for result in unread:
+        results[result.search_id].append(result)
+    if not results:
+        return []
+
+    renderer = RollupRenderer(time_range)
+    notification_ids = []
+    for search in Search.objects.filter(id__in=results).select_related('user'):
+        try:
+            with transaction.atomic():
+                search_results = results[search.id]
+                # only take off the results being sent, so ones published since the query above stay counted
+                Search.objects.filter(id=search.id).update(
+                    last_notified_timestamp=search_results[0].created_at,
+                    unread_count=Greatest(F('unread_count') - len(search_results), 0),
+                )
+
+                notification = Notification.objects.create(
+                    search=search,
+                    user=search.user,
+                    type='e',
+                    message=renderer.render(search, search_results)
+                )
+        except Exception:
+            logging.exception("[Notification Error] rollup for search %s", search.id)
+            continue
+        notification_ids.append(notification.id)
 
-        notification = Notification.objects.create(
-            search=search,
-            user=search.user,
-            type='e',
-            message={
-                'subject': subject_tmpl.render(ctx).strip(),
-                'body': body_text_tmpl.render(ctx),
-                'body_html': inline_css(body_tmpl.render(ctx)),
-                'recipient': search.user.email
-            }
-        )
-
-    return notification.id
+    return notification_ids
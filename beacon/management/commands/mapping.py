@@ -8,6 +8,8 @@ from django.core.management.base import BaseCommand
 from django.contrib.gis.gdal.datasource import DataSource
 from django.contrib.gis.utils import LayerMapping
 from django_countries import countries
+from app.caching import AREAS, bump_tags
+from app.models import Station
 from beacon.models import Area, AreaType
 
 
@@ -52,6 +54,7 @@ class MappingCommand(BaseCommand):
         self.stdout.write('Linking areas...')
 
         parent = Area.objects.get(place_id=self.parent_place_id())
+        area_ids = []
 
         for feature in self.model.objects.filter(area=None):
             place_id = self.feature_place_id(feature)
@@ -64,6 +67,11 @@ class MappingCommand(BaseCommand):
             }, place_id=place_id)
             feature.area = area
             feature.save()
+            area_ids.append(area.id)
+
+        self.stdout.write('Assigning stations to areas...')
+        Station.objects.refresh_area_members(area_ids)
+        bump_tags(AREAS)
 
         self.stdout.write('Done!')
 
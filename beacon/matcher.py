@@ -0,0 +1,103 @@
+import uuid
+from collections import defaultdict
+from django.core.cache import cache
+from django.db.models import Prefetch
+from beacon.models import Search, Area
+
+
+VERSION_KEY = 'search_matcher_version'
+
+_matcher = None
+
+
+class SearchMatcher:
+    """
+    An in-memory index of every active search, answering which searches an update should be published to
+    with the same rules as `SearchQuerySet.publish`.
+    """
+
+    def __init__(self, searches, version=None):
+        self.version = version
+        self.all = set()
+        self.any_network = set()
+        self.by_network = defaultdict(set)
+        self.any_plug_type = set()
+        self.by_plug_type = defaultdict(set)
+        self.dc_fast = set()
+        self.only_new = set()
+        self.anywhere = set()
+        self.by_area = defaultdict(set)
+
+        for search in searches:
+            self.all.add(search.id)
+            _index(search.id, search.ev_networks, self.any_network, self.by_network)
+            _index(search.id, search.plug_types, self.any_plug_type, self.by_plug_type)
+            if search.dc_fast:
+                self.dc_fast.add(search.id)
+            if search.only_new:
+                self.only_new.add(search.id)
+            within = [area.id for area in search.within.all()]
+            if not within:
+                self.anywhere.add(search.id)
+            for area_id in within:
+                self.by_area[area_id].add(search.id)
+
+    @classmethod
+    def compile(cls, version=None):
+        searches = Search.objects.filter(user__is_active=True).prefetch_related(
+            Prefetch('within', queryset=Area.objects.only('id'))
+        )
+        return cls(searches, version)
+
+    def match(self, station, is_creation, area_ids) -> set[int]:
+        """
+        Returns the ids of the searches to notify, given the ids of the areas the station belongs to.
+        """
+        candidates = set(self.all)
+
+        if station.ev_network is not None:
+            candidates &= self.any_network | self.by_network.get(station.ev_network, set())
+
+        if station.ev_connector_types:
+            plug_type_matches = set(self.any_plug_type)
+            for plug_type in station.ev_connector_types:
+                plug_type_matches |= self.by_plug_type.get(plug_type, set())
+            candidates &= plug_type_matches
+
+        if station.point is not None and candidates - self.anywhere:
+            area_matches = set(self.anywhere)
+            for area_id in area_ids:
+                area_matches |= self.by_area.get(area_id, set())
+            candidates &= area_matches
+
+        if station.ev_dc_fast_num == 0:
+            candidates -= self.dc_fast
+
+        if not is_creation:
+            candidates -= self.only_new
+
+        return candidates
+
+
+def get_search_matcher() -> SearchMatcher:
+    """
+    Returns this process's compiled matcher, rebuilding it when the shared version has been bumped by
+    `invalidate_search_matcher`.
+    """
+    global _matcher
+    cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+    version = cache.get(VERSION_KEY)
+    if version is None or _matcher is None or _matcher.version != version:
+        _matcher = SearchMatcher.compile(version)
+    return _matcher
+
+
+def invalidate_search_matcher():
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def _index(search_id, values, wildcard, index):
+    if not values:
+        wildcard.add(search_id)
+    for value in values:
+        index[value].add(search_id)
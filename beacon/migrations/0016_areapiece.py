@@ -0,0 +1,31 @@
+# Generated by Django 5.0.1 on 2024-02-07 02:31
+
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('beacon', '0015_alter_searchresult_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AreaPiece',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('geom', django.contrib.gis.db.models.fields.PolygonField(srid=4326)),
+                ('area', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pieces', to='beacon.area')),
+            ],
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO beacon_areapiece (area_id, geom)
+            SELECT area_id, (ST_Dump(piece)).geom
+            FROM (SELECT id AS area_id, ST_Subdivide(geom, 256) AS piece FROM beacon_area WHERE geom IS NOT NULL) pieces
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.1 on 2024-02-09 18:12
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('beacon', '0016_areapiece'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='area',
+            index=models.Index(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('name'), name='text_pattern_ops'), name='area_name_prefix_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.1 on 2024-02-10 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('beacon', '0017_area_name_prefix_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='search',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE beacon_search
+            SET unread_count = (
+                SELECT count(*) FROM beacon_searchresult
+                WHERE beacon_searchresult.search_id = beacon_search.id
+                AND beacon_searchresult.created_at > beacon_search.last_notified_timestamp
+            )
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -1,12 +1,19 @@
+from collections import Counter, defaultdict
 from datetime import datetime
 from django.contrib.gis.db import models
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
 from django.utils import timezone
+from django.db.models import Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Upper
 from django.db.models.query import Q, F
 from django.db.models.aggregates import Count
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import OpClass
 from django.contrib.auth import get_user_model
-from beacon.tasks import schedule_create_email_notification
+from beacon.tasks import schedule_create_email_notifications
+
+
+ROLLUP_BATCH_SIZE = 100
 
 
 class SearchQuerySet(models.QuerySet):
@@ -26,7 +33,7 @@ class SearchQuerySet(models.QuerySet):
 
         # notify searches that are within the station's area or have no areas defined
         if update.station.point is not None:
-            query &= Q(within__geom__contains=update.station.point) | Q(within=None)
+            query &= Q(within__stations=update.station) | Q(within=None)
 
         # if the station is not a DC fast charger, only notify searches that do not specify DC fast chargers
         if update.station.ev_dc_fast_num == 0:
@@ -38,7 +45,7 @@ class SearchQuerySet(models.QuerySet):
 
         searches = self.filter(query)
         errors = []
-        n_success = 0
+        published = []
 
         for search in searches:
             try:
@@ -47,35 +54,87 @@ class SearchQuerySet(models.QuerySet):
                     update=update,
                     idempotency_key=idempotency_key
                 )
-                n_success += 1
+                published.append(search.id)
             except IntegrityError:
                 errors.append(search)
 
-        return n_success, errors
-
-    def with_unread_count(self):
-        newer_than_last_notified = Q(results__created_at__gt=F('last_notified_timestamp'))
-        return self.annotate(
-            unread_count=Count('results', filter=newer_than_last_notified)
+        Search.objects.filter(id__in=published).update(unread_count=F('unread_count') + 1)
+        return len(published), errors
+
+    def publish_many(self, updates) -> int:
+        """
+        Publishes a batch of updates to every matching active search, using the in-memory search matcher and
+        the stations' precomputed area memberships rather than querying searches per update. Results that were
+        already published are ignored.
+        """
+        from beacon.matcher import get_search_matcher
+        matcher = get_search_matcher()
+        updates = list(updates)
+        station_areas = defaultdict(set)
+        if updates:
+            StationArea = updates[0].station.areas.through
+            memberships = StationArea.objects.filter(station_id__in={update.station_id for update in updates})
+            for station_id, area_id in memberships.values_list('station_id', 'area_id'):
+                station_areas[station_id].add(area_id)
+        existing = set(
+            SearchResult.objects.filter(update__in=updates).values_list('search_id', 'update_id', 'idempotency_key')
         )
+        results = [
+            SearchResult(
+                search_id=search_id,
+                update=update,
+                idempotency_key=f'update-{update.id}-{update.created_at}',
+            )
+            for update in updates
+            for search_id in matcher.match(update.station, update.is_creation, station_areas[update.station_id])
+        ]
+        results = [r for r in results if (r.search_id, r.update.id, r.idempotency_key) not in existing]
+        SearchResult.objects.bulk_create(results, batch_size=1000, ignore_conflicts=True)
+
+        # group searches by how many results they gained so the counters move in a handful of UPDATEs
+        gained = Counter(result.search_id for result in results)
+        by_count = defaultdict(list)
+        for search_id, count in gained.items():
+            by_count[count].append(search_id)
+        for count, search_ids in by_count.items():
+            Search.objects.filter(id__in=search_ids).update(unread_count=F('unread_count') + count)
+        return len(results)
+
+    def reconcile_unread_counts(self) -> int:
+        """
+        Recounts the results each search has gained since it was last notified, correcting any counters that
+        drifted. Returns the number of searches corrected.
+        """
+        unread = SearchResult.objects.filter(
+            search=OuterRef('pk'),
+            created_at__gt=OuterRef('last_notified_timestamp'),
+        ).order_by().values('search').annotate(count=Count('id')).values('count')
+        actual = Coalesce(Subquery(unread), 0)
+        return self.exclude(unread_count=actual).update(unread_count=actual)
+
+    def with_unread_results(self):
+        """
+        Searches with results newer than their last notification. The counter narrows the candidates cheaply and
+        the results themselves have the final say, in case a counter has drifted since the last reconcile.
+        """
+        unread = SearchResult.objects.filter(search=OuterRef('pk'), created_at__gt=OuterRef('last_notified_timestamp'))
+        return self.filter(unread_count__gt=0).filter(Exists(unread))
 
     def send_daily_rollup_emails(self):
-        now = timezone.now()
-        eligible_searches = self.with_unread_count().filter(
-            unread_count__gt=0,
-            daily_email=True
-        )
-        for search in eligible_searches:
-            schedule_create_email_notification(search.id, 'daily', now)
+        self.with_unread_results().filter(daily_email=True).schedule_rollups('daily')
 
     def send_weekly_rollup_emails(self):
+        self.with_unread_results().filter(weekly_email=True).schedule_rollups('weekly')
+
+    def schedule_rollups(self, time_range, batch_size=ROLLUP_BATCH_SIZE):
+        """
+        Queues rollup emails for these searches in batches, each created and sent by one task, so a large
+        rollup is spread across the worker pool.
+        """
         now = timezone.now()
-        eligible_searches = self.with_unread_count().filter(
-            unread_count__gt=0,
-            weekly_email=True
-        )
-        for search in eligible_searches:
-            schedule_create_email_notification(search.id, 'weekly', now)
+        search_ids = list(self.order_by('id').values_list('id', flat=True))
+        for i in range(0, len(search_ids), batch_size):
+            schedule_create_email_notifications(search_ids[i:i + batch_size], time_range, now)
 
 
 class Search(models.Model):
@@ -94,6 +153,8 @@ class Search(models.Model):
     last_notified_timestamp = models.DateTimeField(
         default=timezone.make_aware(datetime(1, 1, 1, 0, 0))
     )
+    # results gained since last_notified_timestamp, kept up to date by publishing and email creation
+    unread_count = models.PositiveIntegerField(default=0, editable=False)
 
     objects = SearchQuerySet.as_manager()
 
@@ -138,6 +199,32 @@ class AreaType(models.TextChoices):
     COUNTRY = 'y', 'Country'
 
 
+class AreaQuerySet(models.QuerySet):
+    def subdivide(self, max_vertices=256):
+        """
+        Rebuilds the pieces of each area in this queryset, splitting its geometry into polygons of at most
+        `max_vertices` vertices.
+        """
+        area_ids = list(self.values_list('id', flat=True))
+        AreaPiece.objects.filter(area_id__in=area_ids).delete()
+        with connection.cursor() as cursor:
+            cursor.execute(SUBDIVIDE_SQL.format(
+                piece=AreaPiece._meta.db_table,
+                area=Area._meta.db_table,
+            ), [max_vertices, area_ids])
+
+
+SUBDIVIDE_SQL = """
+INSERT INTO {piece} (area_id, geom)
+SELECT area_id, (ST_Dump(piece)).geom
+FROM (
+    SELECT id AS area_id, ST_Subdivide(geom, %s) AS piece
+    FROM {area}
+    WHERE id = ANY(%s) AND geom IS NOT NULL
+) pieces
+"""
+
+
 class Area(models.Model):
     """
     An area is a geographic region that can be used to filter search results.
@@ -148,12 +235,34 @@ class Area(models.Model):
     belongs_to = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True)
     geom = models.MultiPolygonField(srid=4326, null=True, blank=True)
 
+    objects = AreaQuerySet.as_manager()
+
     class Meta:
         ordering = ['name']
+        indexes = [
+            # matches the UPPER(name) LIKE 'PREFIX%' that name__istartswith compiles to
+            models.Index(OpClass(Upper('name'), name='text_pattern_ops'), name='area_name_prefix_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        Area.objects.filter(pk=self.pk).subdivide()
+
+
+class AreaPiece(models.Model):
+    """
+    A piece of an area's geometry with a bounded number of vertices. Spatial predicates run against the pieces
+    rather than the full resolution shapes, which can have hundreds of thousands of vertices.
+    """
+    area = models.ForeignKey(Area, on_delete=models.CASCADE, related_name='pieces')
+    geom = models.PolygonField(srid=4326)
+
+    def __str__(self):
+        return str(self.area)
+
 
 class ZipCodeTabulationArea(models.Model):
     """
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from beacon.models import Search
+from beacon.matcher import invalidate_search_matcher
+
+
+# fields written by logins, publishing and email creation, none of which the matcher compiles
+BOOKKEEPING_FIELDS = {'last_login', 'last_notified_timestamp', 'unread_count'}
+
+
+@receiver(post_save, sender=Search)
+@receiver(post_delete, sender=Search)
+@receiver(m2m_changed, sender=Search.within.through)
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def search_criteria_changed(sender, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= BOOKKEEPING_FIELDS:
+        return
+    # bump again once committed, in case a worker recompiled from the old rows in the meantime
+    invalidate_search_matcher()
+    transaction.on_commit(invalidate_search_matcher)
@@ -1,6 +1,8 @@
+from smtplib import SMTPRecipientsRefused
+from anymail.exceptions import AnymailInvalidAddress, AnymailRecipientsRefused
 from django.apps import apps
 from django.utils import timezone
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.conf import settings
 from django.contrib.sites.models import Site
 from celery import shared_task
@@ -9,15 +11,26 @@ from celery.utils.log import get_task_logger
 
 logging = get_task_logger(__name__)
 
+# errors that only concern one message's recipient; anything else, such as the provider being down, fails the batch
+RECIPIENT_ERRORS = (SMTPRecipientsRefused, AnymailRecipientsRefused, AnymailInvalidAddress)
+
 
 def schedule_create_email_notification(search_id, time_range, timestamp):
     return create_email_notification.delay(search_id, time_range, timestamp)
 
 
+def schedule_create_email_notifications(search_ids, time_range, timestamp):
+    return create_email_notifications.delay(search_ids, time_range, timestamp)
+
+
 def schedule_html_email(notification_id):
     return send_html_email.delay(notification_id)
 
 
+def schedule_html_emails(notification_ids):
+    return send_html_emails.delay(notification_ids)
+
+
 @shared_task
 def create_daily_rollup_emails():
     Search = apps.get_model("beacon", "Search")
@@ -30,6 +43,13 @@ def create_weekly_rollup_emails():
     Search.objects.send_weekly_rollup_emails()
 
 
+@shared_task
+def reconcile_unread_counts():
+    Search = apps.get_model("beacon", "Search")
+    corrected = Search.objects.reconcile_unread_counts()
+    logging.info("[Reconciled] %d search unread counts", corrected)
+
+
 @shared_task
 def create_email_notification(search_id, time_range, timestamp):
     from beacon.emailer import create_email_notification
@@ -39,6 +59,15 @@ def create_email_notification(search_id, time_range, timestamp):
     schedule_html_email(notif_id)
 
 
+@shared_task
+def create_email_notifications(search_ids, time_range, timestamp):
+    from beacon.emailer import create_email_notifications
+    notification_ids = create_email_notifications(search_ids, time_range, timestamp)
+    logging.info("[Created] %d notifications for %d searches", len(notification_ids), len(search_ids))
+    if notification_ids:
+        schedule_html_emails(notification_ids)
+
+
 @shared_task(
     bind=True,
     autoretry_for=(Exception,),
@@ -62,19 +91,60 @@ def send_html_email(task, notification_id):
 
     logging.info("[Started] sending email to %s", notification.user)
 
-    site = Site.objects.get_current()
+    build_email(notification, Site.objects.get_current()).send()
+
+    notification.sent_at = timezone.now()
+    notification.save()
+
+    logging.info("[Completed] sent email to %s", notification.user)
+    return notification.id
+
+
+@shared_task(
+    bind=True,
+    autoretry_for=(Exception,),
+    retry_backoff=3,
+    retry_kwargs={"max_retries": 3}
+)
+def send_html_emails(task, notification_ids):
+    """
+    Sends a batch of notifications over one email connection. Each is marked sent as soon as it goes out, so a
+    retry only sends the rest. A message whose recipient is refused is logged and skipped.
+    """
+    Notification = apps.get_model("beacon", "Notification")
+    notifications = Notification.objects.filter(id__in=notification_ids, sent_at=None).order_by('id')
 
+    if task.request.retries > 0:
+        logging.info(
+            "[Task Retry] attempt %d/%d",
+            task.request.retries,
+            task.retry_kwargs["max_retries"],
+        )
+
+    site = Site.objects.get_current()
+    sent = 0
+    with get_connection() as connection:
+        for notification in notifications:
+            try:
+                connection.send_messages([build_email(notification, site, connection)])
+            except RECIPIENT_ERRORS as e:
+                logging.error("[Send Error] notification %s to %s: %s", notification.id, notification.user, e)
+                continue
+            notification.sent_at = timezone.now()
+            notification.save(update_fields=['sent_at'])
+            sent += 1
+
+    logging.info("[Completed] sent %d of %d emails", sent, len(notification_ids))
+    return sent
+
+
+def build_email(notification, site, connection=None) -> EmailMultiAlternatives:
     message = EmailMultiAlternatives(
         subject=notification.message['subject'],
         body=notification.message['body'],
         from_email=f'{site.name} <{settings.DEFAULT_FROM_EMAIL}>',
-        to=[notification.message['recipient']]
+        to=[notification.message['recipient']],
+        connection=connection,
     )
     message.attach_alternative(notification.message['body_html'], "text/html")
-    message.send()
-
-    notification.sent_at = timezone.now()
-    notification.save()
-
-    logging.info("[Completed] sent email to %s", notification.user)
-    return notification.id
+    return message
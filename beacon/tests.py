@@ -1,11 +1,23 @@
+from smtplib import SMTPRecipientsRefused, SMTPServerDisconnected
 from unittest import mock
 from datetime import timedelta
-from django.test import TestCase
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail import get_connection
+from django.test import TestCase, override_settings
 from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.contrib.gis.geos import Point, MultiPolygon
+from anymail.exceptions import AnymailRequestsAPIError
+from css_inline import inline_many
 from app.models import Station, Update
-from beacon.models import Search, SearchResult, Notification, NotificationType
-from beacon.tasks import create_email_notification
+from app.renderer import get_changes
+from beacon.models import Search, SearchResult, Notification, NotificationType, Area, AreaType
+from app.caching import AREAS, bump_tags, local_cache
+from beacon.autocomplete import get_area_index
+from beacon.emailer import RollupRenderer
+from beacon.matcher import get_search_matcher
+from beacon.tasks import create_email_notification, create_email_notifications, send_html_emails
 
 
 class BeaconTestCase(TestCase):
@@ -78,6 +90,173 @@ class TestSearch(BeaconTestCase):
         self.assertEqual(SearchResult.objects.filter(search=no_res).count(), 0)
 
 
+class TestSearchPublishMany(BeaconTestCase):
+    def test_publish_many(self):
+        dc_station = Station.objects.create(
+            id=1338,
+            ev_network='Tesla',
+            ev_connector_types=['TESLA'],
+            ev_dc_fast_num=4,
+            point='POINT(-122.123 47.123)'
+        )
+        dc_update = Update.objects.create(station=dc_station, is_creation=False)
+        everything = Search.objects.create(name='test', user=self.user, ev_networks=[], plug_types=[])
+        j1772 = Search.objects.create(name='test2', user=self.user, ev_networks=[], plug_types=['J1772'])
+        dc_fast = Search.objects.create(name='test3', user=self.user, ev_networks=[], plug_types=[], dc_fast=True)
+        only_new = Search.objects.create(name='test4', user=self.user, ev_networks=[], plug_types=[], only_new=True)
+        tesla = Search.objects.create(name='test5', user=self.user, ev_networks=['Tesla'], plug_types=[])
+
+        n_published = Search.objects.publish_many([self.update, dc_update])
+        self.assertEqual(n_published, 6)
+        self.assertEqual(SearchResult.objects.filter(search=everything).count(), 2)
+        self.assertEqual(SearchResult.objects.get(search=j1772).update, self.update)
+        self.assertEqual(SearchResult.objects.get(search=dc_fast).update, dc_update)
+        self.assertEqual(SearchResult.objects.get(search=only_new).update, self.update)
+        self.assertEqual(SearchResult.objects.get(search=tesla).update, dc_update)
+        everything.refresh_from_db()
+        j1772.refresh_from_db()
+        self.assertEqual((everything.unread_count, j1772.unread_count), (2, 1))
+
+    def test_publish_many_is_idempotent(self):
+        search = Search.objects.create(name='test', user=self.user, ev_networks=[], plug_types=[])
+        Search.objects.publish_many([self.update])
+        Search.objects.publish_many([self.update])
+        self.assertEqual(SearchResult.objects.count(), 1)
+        search.refresh_from_db()
+        self.assertEqual(search.unread_count, 1)
+
+    def test_publish_many_inactive_user(self):
+        Search.objects.create(name='test', user=self.user, ev_networks=[], plug_types=[])
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(Search.objects.publish_many([self.update]), 0)
+
+
+class TestUnreadCounts(BeaconTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.search = Search.objects.create(name='test', user=self.user, ev_networks=[], plug_types=[])
+
+    def test_publish_increments(self):
+        Search.objects.publish(self.update, 'idem-key')
+        self.search.refresh_from_db()
+        self.assertEqual(self.search.unread_count, 1)
+
+    @mock.patch('beacon.tasks.schedule_html_email')
+    def test_email_resets(self, schedule_email):
+        Search.objects.publish_many([self.update])
+        create_email_notification(self.search.id, 'daily', timezone.now())
+        self.search.refresh_from_db()
+        self.assertEqual(self.search.unread_count, 0)
+
+    @mock.patch('beacon.tasks.schedule_html_email')
+    def test_email_keeps_later_results_counted(self, schedule_email):
+        Search.objects.publish_many([self.update])
+        # as if two more results were counted by publishes racing the email
+        Search.objects.filter(id=self.search.id).update(unread_count=3)
+        create_email_notification(self.search.id, 'daily', timezone.now())
+        self.search.refresh_from_db()
+        self.assertEqual(self.search.unread_count, 2)
+
+    def test_reconcile(self):
+        Search.objects.publish_many([self.update])
+        Search.objects.filter(id=self.search.id).update(unread_count=7)
+        self.assertEqual(Search.objects.reconcile_unread_counts(), 1)
+        self.search.refresh_from_db()
+        self.assertEqual(self.search.unread_count, 1)
+        self.assertEqual(Search.objects.reconcile_unread_counts(), 0)
+
+
+class TestSearchMatcher(BeaconTestCase):
+    def test_match_areas(self):
+        inside = Area.objects.create(
+            name='inside', place_id='inside', area_type=AreaType.STATE,
+            geom='MULTIPOLYGON(((-123 47, -122 47, -122 48, -123 48, -123 47)))'
+        )
+        outside = Area.objects.create(
+            name='outside', place_id='outside', area_type=AreaType.STATE,
+            geom='MULTIPOLYGON(((-100 30, -99 30, -99 31, -100 31, -100 30)))'
+        )
+        anywhere = Search.objects.create(name='test', user=self.user, ev_networks=[], plug_types=[])
+        res1 = Search.objects.create(name='test2', user=self.user, ev_networks=[], plug_types=[])
+        res1.within.add(inside, outside)
+        no_res = Search.objects.create(name='test3', user=self.user, ev_networks=[], plug_types=[])
+        no_res.within.add(outside)
+
+        Station.objects.filter(id=self.station.id).refresh_areas()
+        area_ids = set(self.station.areas.values_list('id', flat=True))
+        self.assertEqual(area_ids, {inside.id})
+        matches = get_search_matcher().match(self.station, self.update.is_creation, area_ids)
+        self.assertEqual(matches, {anywhere.id, res1.id})
+
+        Search.objects.publish_many([self.update])
+        self.assertEqual(SearchResult.objects.filter(search=res1).count(), 1)
+        self.assertEqual(SearchResult.objects.filter(search=no_res).count(), 0)
+
+    def test_matcher_invalidated(self):
+        self.assertEqual(get_search_matcher().match(self.station, True, set()), set())
+        search = Search.objects.create(name='test', user=self.user, ev_networks=[], plug_types=[])
+        self.assertEqual(get_search_matcher().match(self.station, True, set()), {search.id})
+        search.plug_types = ['CHADEMO']
+        search.save()
+        self.assertEqual(get_search_matcher().match(self.station, True, set()), set())
+
+    def test_matcher_kept_on_bookkeeping_save(self):
+        search = Search.objects.create(name='test', user=self.user, ev_networks=[], plug_types=[])
+        matcher = get_search_matcher()
+        search.unread_count = 3
+        search.save(update_fields=['last_notified_timestamp', 'unread_count'])
+        self.assertIs(get_search_matcher(), matcher)
+
+
+class TestAreaPieces(TestCase):
+    def test_area_subdivided_on_save(self):
+        circle = Point(-122, 47).buffer(1, quadsegs=300)
+        area = Area.objects.create(
+            name='circle', place_id='circle', area_type=AreaType.STATE, geom=MultiPolygon(circle, srid=4326)
+        )
+        pieces = list(area.pieces.all())
+        self.assertGreater(len(pieces), 1)
+        for piece in pieces:
+            self.assertLess(piece.geom.num_points, circle.num_points)
+        self.assertAlmostEqual(sum(piece.geom.area for piece in pieces), circle.area)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestAreaAutocomplete(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.washington = Area.objects.create(name='Washington', place_id='us-state-wa', area_type=AreaType.STATE)
+        self.wisconsin = Area.objects.create(name='Wisconsin', place_id='us-state-wi', area_type=AreaType.STATE)
+        self.zip = Area.objects.create(name='98101', place_id='us-zip-98101', area_type=AreaType.ZIP)
+        self.country = Area.objects.create(name='Wakanda', place_id='country-wk', area_type=AreaType.COUNTRY)
+
+    def test_prefix(self):
+        res = self.client.get('/area_autocomplete', {'query': 'w'})
+        self.assertEqual([r['label'] for r in res.json()], ['Washington', 'Wisconsin'])
+        res = self.client.get('/area_autocomplete', {'query': 'wisc'})
+        self.assertEqual([r['label'] for r in res.json()], ['Wisconsin'])
+
+    def test_ranked_by_area_type(self):
+        Area.objects.create(name='W1A', place_id='uk-zip-w1a', area_type=AreaType.ZIP)
+        bump_tags(AREAS)
+        res = self.client.get('/area_autocomplete', {'query': 'w'})
+        self.assertEqual([r['label'] for r in res.json()], ['Washington', 'Wisconsin', 'W1A'])
+
+    def test_selected(self):
+        res = self.client.get('/area_autocomplete', {'query': '98', 'selected': f'{self.washington.id}'})
+        self.assertEqual([(r['label'], r['selected']) for r in res.json()], [('Washington', True), ('98101', False)])
+
+    def test_rebuilt_when_invalidated(self):
+        self.assertEqual(get_area_index().complete('wa'), [(self.washington.id, 'Washington')])
+        Area.objects.create(name='Wales', place_id='uk-wales', area_type=AreaType.STATE)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_area_index().complete('wa'), [(self.washington.id, 'Washington')])
+        bump_tags(AREAS)
+        self.assertEqual([name for _, name in get_area_index().complete('wa')], ['Wales', 'Washington'])
+
+
 class TestNotificationScheduling(BeaconTestCase):
     def setUp(self) -> None:
         super().setUp()
@@ -85,18 +264,18 @@ class TestNotificationScheduling(BeaconTestCase):
             name='test', user=self.user, ev_networks=[], plug_types=[], daily_email=True
         )
 
-    @mock.patch('beacon.models.schedule_create_email_notification')
+    @mock.patch('beacon.models.schedule_create_email_notifications')
     def test_daily_notif_created(self, schedule_create):
         Search.objects.publish(self.update, 'idem-key')
         Search.objects.send_daily_rollup_emails()
-        schedule_create.assert_called_once_with(self.daily_search.id, 'daily', mock.ANY)
+        schedule_create.assert_called_once_with([self.daily_search.id], 'daily', mock.ANY)
 
-    @mock.patch('beacon.models.schedule_create_email_notification')
+    @mock.patch('beacon.models.schedule_create_email_notifications')
     def test_daily_notif_not_created(self, schedule_create):
         Search.objects.send_daily_rollup_emails()
         schedule_create.assert_not_called()
 
-    @mock.patch('beacon.models.schedule_create_email_notification')
+    @mock.patch('beacon.models.schedule_create_email_notifications')
     def test_daily_notif_not_created_no_unread(self, schedule_create):
         Search.objects.publish(self.update, 'idem-key')
         self.daily_search.last_notified_timestamp = timezone.now()  # mark as read
@@ -105,8 +284,106 @@ class TestNotificationScheduling(BeaconTestCase):
         schedule_create.assert_not_called()
 
 
+class TestRollupBatches(BeaconTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.searches = [
+            Search.objects.create(name=f'test{i}', user=self.user, ev_networks=[], plug_types=[], daily_email=True)
+            for i in range(5)
+        ]
+        Search.objects.publish(self.update, 'idem-key')
+
+    @mock.patch('beacon.models.schedule_create_email_notifications')
+    def test_scheduled_in_batches(self, schedule_create):
+        Search.objects.send_daily_rollup_emails()
+        self.assertEqual(schedule_create.call_count, 1)
+        Search.objects.all().schedule_rollups('daily', batch_size=2)
+        self.assertEqual([len(call.args[0]) for call in schedule_create.call_args_list[1:]], [2, 2, 1])
+
+    @mock.patch('beacon.tasks.schedule_html_emails')
+    def test_batch_created_and_sent_over_one_connection(self, schedule_emails):
+        create_email_notifications([search.id for search in self.searches], 'daily', timezone.now())
+        notification_ids = schedule_emails.call_args.args[0]
+        self.assertEqual(len(notification_ids), 5)
+        for search in self.searches:
+            search.refresh_from_db()
+            self.assertEqual(search.unread_count, 0)
+
+        with mock.patch('beacon.tasks.get_connection', wraps=get_connection) as connection:
+            self.assertEqual(send_html_emails(notification_ids), 5)
+        connection.assert_called_once()
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertFalse(Notification.objects.filter(sent_at=None).exists())
+
+        # already sent notifications are skipped on a retry
+        self.assertEqual(send_html_emails(notification_ids), 0)
+
+    @mock.patch('beacon.tasks.schedule_html_emails')
+    def test_failures_isolated_within_batch(self, schedule_emails):
+        failing = self.searches[1]
+        render = RollupRenderer.render
+
+        def render_or_fail(renderer, search, results):
+            if search.id == failing.id:
+                raise ValueError('render failed')
+            return render(renderer, search, results)
+
+        with mock.patch.object(RollupRenderer, 'render', render_or_fail):
+            create_email_notifications([search.id for search in self.searches], 'daily', timezone.now())
+        notification_ids = schedule_emails.call_args.args[0]
+        self.assertEqual(len(notification_ids), 4)
+        failing.refresh_from_db()
+        self.assertEqual(failing.unread_count, 1)
+
+        # the first recipient is rejected, which leaves the rest of the batch to go out
+        connection = mock.MagicMock()
+        connection.__enter__.return_value = connection
+        connection.send_messages.side_effect = [SMTPRecipientsRefused({}), 1, 1, 1]
+        with mock.patch('beacon.tasks.get_connection', return_value=connection):
+            self.assertEqual(send_html_emails(notification_ids), 3)
+        self.assertEqual(list(Notification.objects.filter(sent_at=None).values_list('id', flat=True)),
+                         [min(notification_ids)])
+
+        # the provider being down fails the batch, so it is retried rather than skipped
+        connection.send_messages.side_effect = AnymailRequestsAPIError('Mailgun API response 503')
+        with mock.patch('beacon.tasks.get_connection', return_value=connection):
+            with self.assertRaises(AnymailRequestsAPIError):
+                send_html_emails(notification_ids)
+        self.assertTrue(Notification.objects.filter(id=min(notification_ids), sent_at=None).exists())
+
+        connection.send_messages.side_effect = SMTPServerDisconnected()
+        with mock.patch('beacon.tasks.get_connection', return_value=connection):
+            with self.assertRaises(SMTPServerDisconnected):
+                send_html_emails(notification_ids)
+
+    @mock.patch('beacon.tasks.schedule_html_emails')
+    def test_update_cards_rendered_once_per_batch(self, schedule_emails):
+        with mock.patch('beacon.emailer.get_changes', wraps=get_changes) as changes, \
+                mock.patch('beacon.emailer.inline_many', wraps=inline_many) as inline_cards:
+            create_email_notifications([search.id for search in self.searches], 'daily', timezone.now())
+        changes.assert_called_once()
+        inline_cards.assert_called_once()
+
+        bodies = [n.message['body_html'] for n in Notification.objects.all()]
+        self.assertEqual(len(bodies), 5)
+        self.assertEqual(len(set(bodies)), 5)
+        for body in bodies:
+            self.assertNotIn('<rollup-', body)
+            self.assertIn(self.update.get_absolute_url(), body)
+
+    @mock.patch('beacon.tasks.schedule_html_emails')
+    def test_search_name_cannot_forge_a_card(self, schedule_emails):
+        search = self.searches[0]
+        search.name = f'<rollup-update data-id="{self.update.id + 1}"></rollup-update>'
+        search.save()
+        create_email_notifications([search.id], 'daily', timezone.now())
+        body = Notification.objects.get(search=search).message['body_html']
+        self.assertIn('&lt;rollup-update', body)
+        self.assertIn(self.update.get_absolute_url(), body)
+
+
 class TestNotificationCreation(BeaconTestCase):
-    @mock.patch('beacon.models.schedule_create_email_notification')
+    @mock.patch('beacon.models.schedule_create_email_notifications')
     def setUp(self, schedule_create) -> None:
         super().setUp()
         self.daily_search = Search.objects.create(
@@ -122,7 +399,7 @@ class TestNotificationCreation(BeaconTestCase):
 
 
 class NotificationBeaconTestCase(BeaconTestCase):
-    @mock.patch('beacon.models.schedule_create_email_notification')
+    @mock.patch('beacon.models.schedule_create_email_notifications')
     @mock.patch('beacon.tasks.schedule_html_email')
     def setUp(self, schedule_create, schedule_email) -> None:
         super().setUp()
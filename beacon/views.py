@@ -1,25 +1,15 @@
 from django.http import JsonResponse
-from django.db.models.query import Q
 
-from beacon.models import Area, AreaType
+from beacon.autocomplete import complete_areas
 
 
 def area_autocomplete(request):
-    if user_query := request.GET.get('query', ''):
-        query = Q(
-            name__istartswith=user_query,
-            area_type__in=[AreaType.STATE, AreaType.ZIP],
-        )
-    else:
-        query = Q(area_type=AreaType.STATE)
-    if selected := set(filter(bool, request.GET.get('selected', '').split(','))):
-        query |= Q(id__in=selected)
-
-    areas = Area.objects.filter(query).order_by('name')[:100]
+    selected = set(filter(bool, request.GET.get('selected', '').split(',')))
+    areas = complete_areas(request.GET.get('query', ''), selected)
     results = [{
-        'value': str(area.id),
-        'label': area.name,
-        'selected': str(area.id) in selected
-    } for area in areas]
+        'value': str(area_id),
+        'label': name,
+        'selected': str(area_id) in selected
+    } for area_id, name in areas]
 
     return JsonResponse(results, safe=False)
@@ -131,6 +131,11 @@ CELERY_BEAT_SCHEDULE = {
     'sync_fuel_stations_every_15_min': {
         'task': 'app.tasks.sync_fuel_stations',
         'schedule': crontab(minute='*/15'),
+        'kwargs': {'incremental': True},
+    },
+    'reconcile_fuel_stations_nightly': {
+        'task': 'app.tasks.sync_fuel_stations',
+        'schedule': crontab(minute='7', hour='9'),
     },
     'schedule_daily_rollup_emails': {
         'task': 'beacon.tasks.create_daily_rollup_emails',
@@ -140,6 +145,10 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'beacon.tasks.create_weekly_rollup_emails',
         'schedule': crontab(minute='0', hour='6', day_of_week='mon'),
     },
+    'reconcile_unread_counts_hourly': {
+        'task': 'beacon.tasks.reconcile_unread_counts',
+        'schedule': crontab(minute='37'),
+    },
 }
 
 # Caching
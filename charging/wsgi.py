@@ -10,7 +10,17 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/wsgi/
 import os
 
 from django.core.wsgi import get_wsgi_application
+from django.db import DatabaseError
+from redis.exceptions import RedisError
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'charging.settings')
 
 application = get_wsgi_application()
+
+# build the in-memory area autocomplete index as each worker starts rather than on its first request; when the
+# database or cache is unavailable it is left to be built lazily
+from beacon.autocomplete import get_area_index  # noqa: E402
+try:
+    get_area_index()
+except (DatabaseError, RedisError):
+    pass